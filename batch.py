@@ -0,0 +1,214 @@
+"""Run many independent simulations on all cores and summarize their results."""
+
+from __future__ import annotations
+
+import math
+import os
+import random
+import statistics
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, List, NamedTuple, Optional
+
+from main import (
+    CommonRandomNumbers,
+    Rules,
+    State,
+    Time,
+    run_events,
+    spawn_rng,
+    spawn_seed,
+)
+
+# z-score of 95% confidence intervals
+Z = 1.96
+# runs before trusting the variance to decide whether to stop, and the most runs we make
+MIN_RUNS = 30
+MAX_RUNS = 100_000
+# runs sent to a worker at once by `run_until_precise`, small so that we don't run many more than
+# needed once the target is met
+CHUNK = 4
+
+
+class RunResult(NamedTuple):
+    """What we keep from a single simulation run."""
+
+    run: int
+    ticks: int
+    peak_foos: int
+    peak_bars: int
+    peak_foobars: int
+    peak_money: int
+    money: int
+
+    @property
+    def finish_time(self) -> Time:
+        return Time(self.ticks)
+
+
+def run_batch(
+    n_runs: int,
+    jobs: Optional[int] = None,
+    seed: Optional[int] = None,
+    target_robots: int = 30,
+    rules: Optional[Rules] = None,
+    crn: bool = False,
+) -> List[RunResult]:
+    """Run the simulation `n_runs` times on `jobs` worker processes, under `rules` if given.
+
+    Run n uses `spawn_rng(seed, n)`, or common random numbers seeded with `spawn_seed(seed, n)`
+    with `crn`, so its result doesn't depend on `jobs`. Results are returned in run order.
+    """
+    if seed is None:
+        seed = random.getrandbits(64)
+    jobs = jobs or os.cpu_count() or 1
+    chunksize = max(1, n_runs // (jobs * 4))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(
+            executor.map(
+                run_one,
+                [seed] * n_runs,
+                range(n_runs),
+                [target_robots] * n_runs,
+                [rules] * n_runs,
+                [crn] * n_runs,
+                chunksize=chunksize,
+            )
+        )
+
+
+class RunningStats:
+    """Mean and variance of values added one at a time, with Welford's algorithm."""
+
+    __slots__ = ("count", "mean", "m2")
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        # sum of squared differences with the mean
+        self.m2 = 0.0
+
+    def add(self, value: float):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    @property
+    def variance(self) -> float:
+        return self.m2 / (self.count - 1) if self.count > 1 else math.inf
+
+    def half_width(self) -> float:
+        """Return the half width of the confidence interval of the mean."""
+        return Z * math.sqrt(self.variance / self.count) if self.count else math.inf
+
+
+def run_until_precise(
+    precision: float,
+    jobs: Optional[int] = None,
+    seed: Optional[int] = None,
+    target_robots: int = 30,
+    rules: Optional[Rules] = None,
+    crn: bool = False,
+    max_runs: int = MAX_RUNS,
+) -> List[RunResult]:
+    """Run the simulation until the mean finishing time is known to ± `precision` seconds.
+
+    Runs are made like in `run_batch`, a few at a time on each worker, and added to the statistics
+    in run order as they come back, so where we stop only depends on `seed`. We stop once the
+    confidence interval of the mean is narrow enough after at least `MIN_RUNS` runs, or after
+    `max_runs` runs. Results are returned in run order.
+    """
+    if seed is None:
+        seed = random.getrandbits(64)
+    jobs = jobs or os.cpu_count() or 1
+    stats = RunningStats()
+    results: List[RunResult] = []
+    # chunks which came back before the ones of earlier runs, by first run
+    arrived: Dict[int, List[RunResult]] = {}
+    submitted = 0
+    pending = set()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        while len(results) < max_runs:
+            # two chunks per worker, so that none waits while we look at results
+            while len(pending) < 2 * jobs and submitted < max_runs:
+                count = min(CHUNK, max_runs - submitted)
+                pending.add(
+                    executor.submit(
+                        run_chunk, seed, submitted, count, target_robots, rules, crn
+                    )
+                )
+                submitted += count
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk = future.result()
+                arrived[chunk[0].run] = chunk
+            while len(results) in arrived:
+                for result in arrived.pop(len(results)):
+                    results.append(result)
+                    stats.add(result.finish_time.as_seconds())
+                    if stats.count >= MIN_RUNS and stats.half_width() <= precision:
+                        for future in pending:
+                            future.cancel()
+                        return results
+    return results
+
+
+def run_chunk(
+    seed: int,
+    start: int,
+    count: int,
+    target_robots: int = 30,
+    rules: Optional[Rules] = None,
+    crn: bool = False,
+) -> List[RunResult]:
+    return [
+        run_one(seed, run, target_robots, rules, crn)
+        for run in range(start, start + count)
+    ]
+
+
+def run_one(
+    seed: int,
+    run: int,
+    target_robots: int = 30,
+    rules: Optional[Rules] = None,
+    crn: bool = False,
+) -> RunResult:
+    # workers only report their result, the simulation logs nothing by default so it only needs
+    # to count items
+    state = State(
+        spawn_rng(seed, run),
+        lineage=False,
+        rules=rules,
+        crn=CommonRandomNumbers(spawn_seed(seed, run)) if crn else None,
+    )
+    state = run_events(state, target_robots)
+    return RunResult(
+        run=run,
+        ticks=state.clock.n,
+        peak_foos=state.peak_foos,
+        peak_bars=state.peak_bars,
+        peak_foobars=state.peak_foobars,
+        peak_money=state.peak_money.n,
+        money=state.money.n,
+    )
+
+
+def log_batch_summary(results: List[RunResult], seed: int):
+    seconds = [r.finish_time.as_seconds() for r in results]
+    print(f"Finished {len(results)} runs with seed {seed}:")
+    if len(seconds) > 1:
+        quantiles = statistics.quantiles(seconds, n=20)
+        p5, p50, p95 = quantiles[0], quantiles[9], quantiles[18]
+        stdev = statistics.stdev(seconds)
+        print(f"mean:\t{statistics.mean(seconds):.1f}s ± {stdev:.1f}s")
+        print(f"95% CI:\t± {Z * stdev / math.sqrt(len(seconds)):.2f}s")
+        print(f"p5:\t{p5:.1f}s")
+        print(f"p50:\t{p50:.1f}s")
+        print(f"p95:\t{p95:.1f}s")
+    print(f"min:\t{min(seconds)}s")
+    print(f"max:\t{max(seconds)}s")
+    print(f"peak foos:\t{max(r.peak_foos for r in results)}")
+    print(f"peak bars:\t{max(r.peak_bars for r in results)}")
+    print(f"peak foobars:\t{max(r.peak_foobars for r in results)}")
+    print(f"peak money:\t{max(r.peak_money for r in results)}€")
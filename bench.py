@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""Benchmark the event engine at several fleet sizes, and compare to a baseline.
+
+Each case runs the simulation with a fixed seed and no output until it has some number of robots,
+in a fresh process so that its peak RSS is its own. Run `python3 bench.py --save` to record a
+baseline, then `python3 bench.py` fails if a metric got worse than the baseline by more than the
+tolerance. Timings depend on the machine, so record the baseline on the one you compare on.
+
+`python3 bench.py --scaling` instead times each phase of the simulation loop separately, and
+reports how the cost of each one per unit of work grows with the number of robots.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, NamedTuple
+
+import main as sim
+from main import Log, LogLevel, State, run_events
+from profiler import PHASES
+
+ROBOTS = [30, 300, 3000, 30000]
+SCALING_ROBOTS = [300, 1000, 3000, 10000]
+SEED = 1
+BASELINE = "bench_baseline.json"
+# small cases run in a few milliseconds, repeat them for at least this long and keep the best time
+MIN_DURATION = 1.0
+
+
+class BenchResult(NamedTuple):
+    robots: int
+    seed: int
+    ticks: int
+    events: int
+    wall_time: float
+    peak_rss_kb: int
+
+    @property
+    def ticks_per_second(self) -> float:
+        return self.ticks / self.wall_time
+
+    @property
+    def events_per_second(self) -> float:
+        return self.events / self.wall_time
+
+    def metrics(self) -> Dict[str, float]:
+        return {
+            "wall_time": self.wall_time,
+            "ticks_per_second": self.ticks_per_second,
+            "events_per_second": self.events_per_second,
+            "peak_rss_kb": self.peak_rss_kb,
+        }
+
+
+# whether a higher value of each metric is better
+HIGHER_IS_BETTER = {
+    "wall_time": False,
+    "ticks_per_second": True,
+    "events_per_second": True,
+    "peak_rss_kb": False,
+}
+
+
+def run_case(robots: int, seed: int = SEED) -> BenchResult:
+    best = float("inf")
+    total = 0.0
+    while total < MIN_DURATION:
+        # lineage is only needed by event logs and traces
+        state = State(random.Random(seed), lineage=False)
+        start = time.perf_counter()
+        state = run_events(state, robots)
+        elapsed = time.perf_counter() - start
+        best = min(best, elapsed)
+        total += elapsed
+    return BenchResult(
+        robots=robots,
+        seed=seed,
+        ticks=state.clock.n,
+        events=state.metrics.finished_actions,
+        wall_time=best,
+        # kilobytes on Linux
+        peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    )
+
+
+def run_benchmarks(robots: List[int], seed: int = SEED) -> List[BenchResult]:
+    results = []
+    for n in robots:
+        # a new process for every case, so that peak RSS isn't the one of a larger case
+        with ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            result = executor.submit(run_case, n, seed).result()
+        log_result(result)
+        results.append(result)
+    return results
+
+
+def log_result(result: BenchResult):
+    print(
+        f"{result.robots:>6} robots: {result.wall_time:8.3f}s | "
+        f"{result.ticks_per_second:10.0f} ticks/s | "
+        f"{result.events_per_second:10.0f} events/s | "
+        f"{result.peak_rss_kb / 1024:7.1f} MB"
+    )
+
+
+def save_baseline(results: List[BenchResult], path: str):
+    baseline = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": [r._asdict() for r in results],
+    }
+    with open(path, "w") as f:
+        json.dump(baseline, f, indent=2)
+        f.write("\n")
+
+
+def load_baseline(path: str) -> Dict[int, BenchResult]:
+    with open(path) as f:
+        baseline = json.load(f)
+    return {r["robots"]: BenchResult(**r) for r in baseline["results"]}
+
+
+def find_regressions(
+    results: List[BenchResult], baseline: Dict[int, BenchResult], tolerance: float
+) -> List[str]:
+    """Describe every metric which is worse than in the baseline by more than `tolerance`."""
+    regressions = []
+    for result in results:
+        base = baseline.get(result.robots)
+        if base is None:
+            continue
+        if (base.seed, base.ticks, base.events) != (
+            result.seed,
+            result.ticks,
+            result.events,
+        ):
+            print(
+                f"{result.robots} robots: the simulation changed since the baseline, "
+                f"{base.ticks} ticks and {base.events} events then, "
+                f"{result.ticks} ticks and {result.events} events now"
+            )
+        for name, value in result.metrics().items():
+            base_value = base.metrics()[name]
+            if HIGHER_IS_BETTER[name]:
+                worse = value < base_value * (1 - tolerance)
+            else:
+                worse = value > base_value * (1 + tolerance)
+            if worse:
+                regressions.append(
+                    f"{result.robots} robots: {name} went from {base_value:.6g} to {value:.6g}"
+                )
+    return regressions
+
+
+# what the time of each phase is divided by: the update phase handles robots finishing an action
+# or a task change, dispatch handles idle robots, and log runs once per pass
+UNITS = {"update": "completion", "dispatch": "idle robot", "log": "call"}
+# complexity classes we fit phase timings to
+MODELS: Dict[str, Callable[[float], float]] = {
+    "O(1)": lambda n: 1,
+    "O(n)": lambda n: n,
+    "O(n log n)": lambda n: n * math.log(n),
+    "O(n²)": lambda n: n * n,
+}
+
+
+# what the dispatch phase calls, to count per idle robot
+COUNTED_CALLS = {
+    sim.should_this_robot_do_that_action.__code__: "should_this_robot_do_that_action",
+    sim.FutureState.__init__.__code__: "FutureState",
+}
+
+
+class UnitProfiler:
+    """Stands in for `profiler.PhaseProfiler` to add up the time and units of work of each phase.
+
+    Runs to larger fleets are longer, so total times would grow with the number of robots even if
+    no phase did. Only passes made once the fleet has half of `robots` count, so that the costs are
+    those of a fleet of about that size. With `count_calls`, it instead counts the calls of
+    `COUNTED_CALLS` made by the dispatch phase, which makes it too slow to be timed.
+    """
+
+    def __init__(self, robots: int, count_calls: bool = False):
+        self.robots = robots
+        self.count_calls = count_calls
+        self.times = dict.fromkeys(PHASES, 0.0)
+        self.units = dict.fromkeys(PHASES, 0)
+        self.calls = dict.fromkeys(COUNTED_CALLS.values(), 0)
+
+    def timed(self, phase: str, func: Callable[[State], State]):
+        clock = time.perf_counter
+        units = UNIT_COUNTS[phase]
+        counted = self.count_calls and phase == "dispatch"
+
+        def timed_phase(state: State) -> State:
+            if 2 * len(state.robots) < self.robots:
+                return func(state)
+            self.units[phase] += units(state)
+            if counted:
+                sys.setprofile(self.count_call)
+                try:
+                    return func(state)
+                finally:
+                    sys.setprofile(None)
+            start = clock()
+            result = func(state)
+            self.times[phase] += clock() - start
+            return result
+
+        return timed_phase
+
+    def count_call(self, frame, event: str, arg):
+        if event == "call":
+            name = COUNTED_CALLS.get(frame.f_code)
+            if name:
+                self.calls[name] += 1
+
+
+# how many units of work each phase is given, counted before it runs
+UNIT_COUNTS: Dict[str, Callable[[State], int]] = {
+    "update": lambda state: len(
+        state.timers.buckets[state.clock.n % state.timers.size]
+    ),
+    "dispatch": lambda state: len(state.idle_robots),
+    "log": lambda state: 1,
+}
+
+
+def run_phases(robots: int, seed: int, count_calls: bool) -> UnitProfiler:
+    profiler = UnitProfiler(robots, count_calls)
+    with open(os.devnull, "w") as devnull:
+        state = State(
+            random.Random(seed), Log(LogLevel.TICK, devnull), profiler=profiler
+        )
+        run_events(state, robots)
+    return profiler
+
+
+def time_phases(robots: int, seed: int = SEED) -> Dict[str, float]:
+    """Run the simulation and return the time of each phase per unit."""
+    profiler = run_phases(robots, seed, count_calls=False)
+    return {
+        phase: profiler.times[phase] / max(profiler.units[phase], 1) for phase in PHASES
+    }
+
+
+def count_calls(robots: int, seed: int = SEED) -> Dict[str, float]:
+    """Run the simulation and count calls which the dispatch phase makes per idle robot."""
+    profiler = run_phases(robots, seed, count_calls=True)
+    dispatched = max(profiler.units["dispatch"], 1)
+    return {name: n / dispatched for name, n in profiler.calls.items()}
+
+
+def fit_scaling(sizes: List[int], times: List[float]) -> Dict[str, float]:
+    """Fit `times` to the growth of `sizes`.
+
+    Returns the exponent k of the best fitting power law c * n^k, and the residual of each model
+    of `MODELS`, fitted in log space so that small and large sizes weigh the same.
+    """
+    xs = [math.log(n) for n in sizes]
+    ys = [math.log(max(t, 1e-9)) for t in times]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    exponent = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / sum(
+        (x - mean_x) ** 2 for x in xs
+    )
+    fit = {"exponent": exponent}
+    for name, model in MODELS.items():
+        logs = [y - math.log(model(n)) for n, y in zip(sizes, ys)]
+        log_c = sum(logs) / len(logs)
+        fit[name] = sum((v - log_c) ** 2 for v in logs)
+    return fit
+
+
+def scaling_report(sizes: List[int], seed: int = SEED):
+    times = {phase: [] for phase in PHASES}
+    print(
+        "robots\t"
+        + "\t".join(f"{phase} (µs/{UNITS[phase]})" for phase in PHASES)
+        + "\tshould_do calls/idle robot\tFutureState builds/idle robot"
+    )
+    for n in sizes:
+        phase_times = time_phases(n, seed)
+        calls = count_calls(n, seed)
+        for phase in PHASES:
+            times[phase].append(phase_times[phase])
+        print(
+            f"{n}\t"
+            + "\t".join(f"{phase_times[phase] * 1e6:.2f}" for phase in PHASES)
+            + f"\t{calls['should_this_robot_do_that_action']:.2f}"
+            + f"\t{calls['FutureState']:.2f}"
+        )
+    if len(sizes) < 2:
+        return
+    for phase in PHASES:
+        fit = fit_scaling(sizes, times[phase])
+        best = min(MODELS, key=fit.get)
+        print(f"{phase}:\tn^{fit['exponent']:.2f}, closest to {best}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--robots",
+        type=int,
+        nargs="+",
+        help=f"robot targets to run, defaults to {' '.join(map(str, ROBOTS))}, or "
+        f"{' '.join(map(str, SCALING_ROBOTS))} with --scaling",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=SEED, help="seed for the random generator"
+    )
+    parser.add_argument(
+        "--baseline", default=BASELINE, help=f"baseline file, defaults to {BASELINE}"
+    )
+    parser.add_argument(
+        "--save", action="store_true", help="save results as the new baseline"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="fail if a metric is worse than the baseline by more than this fraction",
+    )
+    parser.add_argument(
+        "--scaling",
+        action="store_true",
+        help="time each phase of the simulation loop and fit how it grows with the number of "
+        "robots",
+    )
+    args = parser.parse_args()
+    if args.scaling:
+        scaling_report(args.robots or SCALING_ROBOTS, args.seed)
+        return
+    results = run_benchmarks(args.robots or ROBOTS, args.seed)
+    if args.save:
+        save_baseline(results, args.baseline)
+        return
+    try:
+        baseline = load_baseline(args.baseline)
+    except FileNotFoundError:
+        print(f"No baseline in {args.baseline}, record one with --save.")
+        return
+    regressions = find_regressions(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
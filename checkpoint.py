@@ -0,0 +1,329 @@
+"""Save a running simulation to a compact binary file, and resume it later.
+
+A checkpoint is a header followed by these little-endian sections:
+
+    scalars     lineage flag, then clock, counters, money, peaks and `Metrics` as i64
+    rules       robot cost as i64 and assembly success chance as f64, see `main.Rules`
+    rng         state of `random.Random`: version, 625 words and the cached gaussian
+    crn         whether there are common random numbers, and if so their seed as a
+                length-prefixed string, the number of streams and one `STREAM` record per stream
+    inventory   number of foos, bars and foobars, then their serials as u32 unless only counted,
+                two serials per foobar
+    robots      number of robots, then one `ROBOT` record per robot, see `encode_robot`
+    payload     number of serials, then the u32 serials of foobars being sold and foos being spent
+
+Idle robots, planned actions and other indexes are rebuilt from the robots. A trace of the
+resumed simulation starts with a snapshot of the inventories, see `tracefile.py`. `main.run_ticks` and
+`main.run_events` stop between ticks when given `until`, and either engine can resume from there.
+"""
+
+from __future__ import annotations
+
+import os
+import random
+import struct
+import sys
+from array import array
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+from main import (
+    ASSEMBLING_FOOBAR,
+    BUY_NEW_ROBOT,
+    CHANGING_TASK,
+    IDLE,
+    IDLE_AFTER,
+    MINING_BAR,
+    MINING_FOO,
+    SELLING_FOOBARS,
+    Bar,
+    CommonRandomNumbers,
+    Foo,
+    Foobar,
+    Log,
+    Metrics,
+    Money,
+    Robot,
+    RobotAction,
+    RobotActionAssemblingFoobar,
+    RobotActionBuyNewRobot,
+    RobotActionChangingTask,
+    RobotActionMiningBar,
+    RobotActionMiningFoo,
+    RobotActionSellingFoobars,
+    Rules,
+    State,
+    Time,
+    trace_inventories,
+)
+from profiler import PhaseProfiler
+from tracefile import TraceWriter
+
+MAGIC = b"FBCK"
+VERSION = 4
+HEADER = struct.Struct("<4sI")
+SCALARS = struct.Struct("<B8q" + "q" * len(Metrics.__slots__))
+RULES = struct.Struct("<qd")
+RNG = struct.Struct("<I625IBd")
+# robot, action and number of draws of a `main.CommonRandomNumbers` stream
+STREAM = struct.Struct("<IBQ")
+COUNTS = struct.Struct("<QQQ")
+LENGTH = struct.Struct("<Q")
+FLAG = struct.Struct("<B")
+# opcode, task it is or will be doing (previous task of idle robots), task duration, tick at which
+# the action finishes, tick of its timer, and two operands: foo and bar being assembled, or number
+# of serials it holds in the payload section
+ROBOT = struct.Struct("<BBBIIII")
+
+
+def save(state: State, path: str):
+    """Write a checkpoint of `state` to `path`, replacing any previous one in a single step."""
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        dump(state, f)
+    os.replace(tmp, path)
+
+
+def load(
+    path: str,
+    log: Optional[Log] = None,
+    trace: Optional[TraceWriter] = None,
+    profiler: Optional[PhaseProfiler] = None,
+) -> State:
+    """Read a checkpoint, logging, tracing and profiling the resumed simulation as asked.
+
+    A custom `Rules.policy` is not saved, the resumed simulation uses the default one.
+    """
+    with open(path, "rb") as f:
+        return read(f, log, trace, profiler)
+
+
+def dump(state: State, out: BinaryIO):
+    lineage = state.lineage
+    out.write(HEADER.pack(MAGIC, VERSION))
+    out.write(
+        SCALARS.pack(
+            lineage,
+            state.clock.n,
+            state.foo_ctr,
+            state.bar_ctr,
+            state.money.n,
+            state.peak_foos,
+            state.peak_bars,
+            state.peak_foobars,
+            state.peak_money.n,
+            *(getattr(state.metrics, name) for name in Metrics.__slots__),
+        )
+    )
+    out.write(RULES.pack(state.rules.robot_cost.n, state.rules.success_chance))
+    version, words, gauss_next = state.rng.getstate()
+    out.write(RNG.pack(version, *words, gauss_next is not None, gauss_next or 0.0))
+    write_crn(out, state.crn)
+    out.write(COUNTS.pack(len(state.foos), len(state.bars), len(state.foobars)))
+    if lineage:
+        write_serials(out, state.foos)
+        write_serials(out, state.bars)
+        write_serials(out, serials_of_foobars(state.foobars))
+    payload = array("I")
+    robots = bytearray()
+    timers = state.timers.scheduled(state.clock)
+    for robot in state.robots:
+        robots += encode_robot(robot.action, timers.get(robot.id, 0), payload)
+    out.write(LENGTH.pack(len(state.robots)))
+    out.write(robots)
+    out.write(LENGTH.pack(len(payload)))
+    write_serials(out, payload)
+
+
+def read(
+    f: BinaryIO,
+    log: Optional[Log] = None,
+    trace: Optional[TraceWriter] = None,
+    profiler: Optional[PhaseProfiler] = None,
+) -> State:
+    magic, version = read_struct(f, HEADER)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Not a version {VERSION} checkpoint.")
+    lineage, clock, foo_ctr, bar_ctr, money, *rest = read_struct(f, SCALARS)
+    peak_foos, peak_bars, peak_foobars, peak_money, *metrics = rest
+    robot_cost, success_chance = read_struct(f, RULES)
+    rules = Rules(Money(robot_cost), success_chance)
+    rng_version, *words, has_gauss, gauss_next = read_struct(f, RNG)
+    rng = random.Random()
+    rng.setstate((rng_version, tuple(words), gauss_next if has_gauss else None))
+    crn = read_crn(f)
+
+    state = State(
+        rng,
+        log,
+        trace,
+        lineage=bool(lineage),
+        profiler=profiler,
+        rules=rules,
+        crn=crn,
+    )
+    state.clock = Time(clock)
+    state.foo_ctr = foo_ctr
+    state.bar_ctr = bar_ctr
+    state.money = Money(money)
+    state.peak_foos = peak_foos
+    state.peak_bars = peak_bars
+    state.peak_foobars = peak_foobars
+    state.peak_money = Money(peak_money)
+    for name, value in zip(Metrics.__slots__, metrics):
+        setattr(state.metrics, name, value)
+
+    num_foos, num_bars, num_foobars = read_struct(f, COUNTS)
+    if lineage:
+        state.foos.extend(map(Foo, read_serials(f, num_foos)))
+        state.bars.extend(map(Bar, read_serials(f, num_bars)))
+        state.foobars.extend(foobars_of_serials(read_serials(f, 2 * num_foobars)))
+    else:
+        state.foos.count = num_foos
+        state.bars.count = num_bars
+        state.foobars.count = num_foobars
+
+    (num_robots,) = read_struct(f, LENGTH)
+    records = read_exactly(f, num_robots * ROBOT.size)
+    (payload_size,) = read_struct(f, LENGTH)
+    payload = iter(read_serials(f, payload_size))
+    state.robots = []
+    state.idle_robots = set()
+    for record in ROBOT.iter_unpack(records):
+        robot = Robot(len(state.robots))
+        robot.action = decode_robot(record, payload, bool(lineage))
+        state.robots.append(robot)
+        restore_robot(state, robot, timer=record[4])
+    if trace:
+        # the trace starts here, with the world as it was at the end of the last tick run
+        trace_inventories(state, max(clock - 1, 0))
+    return state
+
+
+def write_crn(out: BinaryIO, crn: Optional[CommonRandomNumbers]):
+    out.write(FLAG.pack(crn is not None))
+    if crn is None:
+        return
+    seed = str(crn.seed).encode()
+    out.write(LENGTH.pack(len(seed)))
+    out.write(seed)
+    out.write(LENGTH.pack(len(crn.streams)))
+    for (robot_id, op), stream in crn.streams.items():
+        out.write(STREAM.pack(robot_id, op, stream.draws))
+
+
+def read_crn(f: BinaryIO) -> Optional[CommonRandomNumbers]:
+    (has_crn,) = read_struct(f, FLAG)
+    if not has_crn:
+        return None
+    (length,) = read_struct(f, LENGTH)
+    crn = CommonRandomNumbers(int(read_exactly(f, length)))
+    (num_streams,) = read_struct(f, LENGTH)
+    for robot_id, op, draws in STREAM.iter_unpack(
+        read_exactly(f, num_streams * STREAM.size)
+    ):
+        crn.restore(robot_id, op, draws)
+    return crn
+
+
+def encode_robot(action: RobotAction, timer: int, payload: array) -> bytes:
+    if action.opcode == IDLE:
+        return ROBOT.pack(IDLE, action.prev_op, 0, 0, 0, 0, 0)
+    task = action.next_task if action.opcode == CHANGING_TASK else action
+    a = b = 0
+    if task.opcode == ASSEMBLING_FOOBAR:
+        a, b = task.foo or 0, task.bar or 0
+    elif task.opcode == SELLING_FOOBARS:
+        a = 2 * len(task.foobars)
+        payload.extend(serials_of_foobars(task.foobars))
+    elif task.opcode == BUY_NEW_ROBOT:
+        a = len(task.foos)
+        payload.extend(foo or 0 for foo in task.foos)
+    return ROBOT.pack(
+        action.opcode, task.opcode, task.duration.n, action.finishes_at, timer, a, b
+    )
+
+
+def decode_robot(
+    record: Tuple[int, ...], payload: Iterator[int], lineage: bool
+) -> RobotAction:
+    op, task_op, duration, finishes_at, _, a, b = record
+    if op == IDLE:
+        return IDLE_AFTER[task_op]
+    serials = [next(payload) for _ in range(a)] if task_op != ASSEMBLING_FOOBAR else []
+    if task_op == MINING_FOO:
+        task = RobotActionMiningFoo()
+    elif task_op == MINING_BAR:
+        # the duration was drawn when the robot was given the task
+        task = RobotActionMiningBar.__new__(RobotActionMiningBar)
+        task.duration = Time(duration)
+    elif task_op == ASSEMBLING_FOOBAR:
+        task = RobotActionAssemblingFoobar(
+            Foo(a) if lineage else None, Bar(b) if lineage else None
+        )
+    elif task_op == SELLING_FOOBARS:
+        if lineage:
+            task = RobotActionSellingFoobars(list(foobars_of_serials(serials)))
+        else:
+            task = RobotActionSellingFoobars([None] * (a // 2))
+    else:
+        task = RobotActionBuyNewRobot(
+            [Foo(s) for s in serials] if lineage else [None] * a
+        )
+    action = RobotActionChangingTask(task) if op == CHANGING_TASK else task
+    action.finishes_at = finishes_at
+    return action
+
+
+def restore_robot(state: State, robot: Robot, timer: int):
+    """Rebuild what `State` keeps about a robot besides its action."""
+    action = robot.action
+    if action.opcode == IDLE:
+        state.idle_robots.add(robot.id)
+        if action.prev_op != IDLE:
+            state.recent_robots[action.prev_op].add(robot.id)
+        return
+    task = action.next_task if action.opcode == CHANGING_TASK else action
+    state.planned_actions[task.opcode] += 1
+    if task.opcode == SELLING_FOOBARS:
+        state.planned_profit.add(task.profit)
+    if action.opcode == BUY_NEW_ROBOT:
+        state.recent_robots[BUY_NEW_ROBOT].add(robot.id)
+    # the timer may be due this tick, if the simulation was saved before its update phase
+    state.timers.schedule(robot.id, timer, Time(state.clock.n - 1))
+
+
+def serials_of_foobars(foobars) -> Iterator[int]:
+    for foobar in foobars:
+        yield foobar.foo if foobar else 0
+        yield foobar.bar if foobar else 0
+
+
+def foobars_of_serials(serials: List[int]) -> Iterator[Foobar]:
+    for i in range(0, len(serials), 2):
+        yield Foobar(Foo(serials[i]), Bar(serials[i + 1]))
+
+
+def read_exactly(f: BinaryIO, size: int) -> bytes:
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("Truncated checkpoint.")
+    return data
+
+
+def read_struct(f: BinaryIO, layout: struct.Struct) -> Tuple:
+    return layout.unpack(read_exactly(f, layout.size))
+
+
+def write_serials(out: BinaryIO, serials):
+    words = array("I", serials)
+    if sys.byteorder == "big":
+        words.byteswap()
+    out.write(words.tobytes())
+
+
+def read_serials(f: BinaryIO, n: int) -> array:
+    words = array("I")
+    words.frombytes(read_exactly(f, n * words.itemsize))
+    if sys.byteorder == "big":
+        words.byteswap()
+    return words
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""Run dispatch policies head to head on the same seeds, and compare their finishing times.
+
+Every policy gets the same runs, run n using `spawn_rng(seed, n)` like `batch.run_batch`, and the
+summary gives 95% confidence intervals of the mean, median and 95th percentile finishing times.
+Runs of two policies with the same seed are paired: the summary also gives the mean difference
+of each policy with the first one, and how many runs it takes to tell apart a 1% difference. With
+`--crn`, runs use common random numbers, so paired runs see the same luck and far fewer of them
+are needed. Add a policy to `POLICIES` to try it.
+"""
+
+from __future__ import annotations
+
+import argparse
+import math
+import random
+import statistics
+from typing import Dict, List, Optional, Tuple
+
+from batch import run_batch
+from main import DefaultPolicy, DispatchPolicy, Robot, Rules, State
+
+# z-scores of 95% confidence intervals, and of 80% power to detect a difference
+Z = 1.96
+Z_POWER = 0.84
+# difference we want to be able to detect, relative to the mean of the first policy
+EFFECT = 0.01
+
+
+class EagerPolicy(DefaultPolicy):
+    """Like the default policy, but robots never leave a task to those already doing it."""
+
+    def should_do(self, state: State, robot: Robot, op: int) -> bool:
+        return True
+
+
+POLICIES: Dict[str, DispatchPolicy] = {
+    "default": DefaultPolicy(),
+    "eager": EagerPolicy(),
+}
+
+Estimate = Tuple[float, float, float]
+
+
+def mean_interval(values: List[float]) -> Estimate:
+    """Return the mean of `values` and its confidence interval."""
+    mean = statistics.mean(values)
+    half_width = Z * statistics.stdev(values) / math.sqrt(len(values))
+    return mean, mean - half_width, mean + half_width
+
+
+def quantile_interval(values: List[float], q: float) -> Estimate:
+    """Return the `q` quantile of `values` and its confidence interval.
+
+    The interval is between two order statistics, which doesn't assume anything about the
+    distribution of `values`.
+    """
+    ordered = sorted(values)
+    n = len(ordered)
+    percentiles = statistics.quantiles(ordered, n=100, method="inclusive")
+    quantile = percentiles[round(q * 100) - 1]
+    half_width = Z * math.sqrt(n * q * (1 - q))
+    low = max(math.floor(n * q - half_width), 0)
+    high = min(math.ceil(n * q + half_width), n - 1)
+    return quantile, ordered[low], ordered[high]
+
+
+def runs_to_detect(stdev: float, effect: float) -> int:
+    """Return how many samples of a difference with `stdev` tell apart a mean of `effect`."""
+    return math.ceil(((Z + Z_POWER) * stdev / effect) ** 2)
+
+
+def compare_policies(
+    policies: Dict[str, DispatchPolicy],
+    n_runs: int,
+    jobs: Optional[int] = None,
+    seed: Optional[int] = None,
+    target_robots: int = 30,
+    crn: bool = False,
+) -> Dict[str, List[float]]:
+    """Return the finishing times in seconds of `n_runs` runs of each policy."""
+    if seed is None:
+        seed = random.getrandbits(64)
+    return {
+        name: [
+            r.finish_time.as_seconds()
+            for r in run_batch(
+                n_runs, jobs, seed, target_robots, Rules(policy=policy), crn
+            )
+        ]
+        for name, policy in policies.items()
+    }
+
+
+def log_comparison(seconds: Dict[str, List[float]]):
+    def cell(estimate: Estimate) -> str:
+        value, low, high = estimate
+        return f"{value:.1f}s [{low:.1f}, {high:.1f}]"
+
+    print("policy\tmean\t\t\tp50\t\t\tp95")
+    for name, values in seconds.items():
+        print(
+            f"{name}\t{cell(mean_interval(values))}\t"
+            f"{cell(quantile_interval(values, 0.5))}\t"
+            f"{cell(quantile_interval(values, 0.95))}"
+        )
+    (base_name, base), *others = seconds.items()
+    if not others:
+        return
+    effect = EFFECT * statistics.mean(base)
+    print(f"\nversus {base_name}\tmean difference\t\truns to detect {EFFECT:.0%}")
+    for name, values in others:
+        differences = [v - b for v, b in zip(values, base)]
+        # unpaired runs would need that many runs of each policy
+        unpaired = math.sqrt(statistics.variance(values) + statistics.variance(base))
+        print(
+            f"{name}\t\t{cell(mean_interval(differences))}\t"
+            f"{runs_to_detect(statistics.stdev(differences), effect)} paired, "
+            f"{runs_to_detect(unpaired, effect)} unpaired"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--policies",
+        nargs="+",
+        choices=list(POLICIES),
+        default=list(POLICIES),
+        help="policies to compare, defaults to all of them",
+    )
+    parser.add_argument(
+        "--runs", type=int, default=200, help="runs per policy, defaults to 200"
+    )
+    parser.add_argument("--seed", type=int, help="seed for the random generator")
+    parser.add_argument(
+        "--robots", type=int, default=30, help="stop once we have this many robots"
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        help="number of worker processes, defaults to all cores",
+    )
+    parser.add_argument(
+        "--crn",
+        action="store_true",
+        help="give each robot its own random streams, so policies see the same luck",
+    )
+    args = parser.parse_args()
+    if args.runs < 2:
+        parser.error("--runs must be at least 2")
+    policies = {name: POLICIES[name] for name in args.policies}
+    seconds = compare_policies(
+        policies, args.runs, args.jobs, args.seed, args.robots, args.crn
+    )
+    log_comparison(seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+"""Robots stored as parallel NumPy arrays, for simulating very large fleets.
+
+The rules are the same as in `main.py`, but instead of a `Robot` object holding a `RobotAction`
+instance, each robot is an index into arrays holding its action opcode, deadline, previous action
+and payload. Finished actions are found with vectorized masks, and the dispatch pass only visits
+idle robots, reading running counters instead of scanning the whole fleet.
+"""
+
+from __future__ import annotations
+
+import random
+from collections import deque
+from typing import Deque, List, Optional, Tuple
+
+import numpy as np
+
+from main import (
+    ASSEMBLING_FOOBAR,
+    BUY_NEW_ROBOT,
+    CHANGING_TASK,
+    IDLE,
+    MINING_BAR,
+    MINING_FOO,
+    NUM_OPS,
+    SELLING_FOOBARS,
+    TIE_TOLERANCE,
+    RobotActionAssemblingFoobar,
+    RobotActionBuyNewRobot,
+    RobotActionChangingTask,
+    RobotActionMiningFoo,
+    RobotActionSellingFoobars,
+    Log,
+    Time,
+)
+
+# Robots are stored by action opcode, see `main.py`. Idle robots keep the opcode of their previous
+# action in `Fleet.prev_op`, where IDLE means the robot has not done anything yet.
+
+DURATIONS = {
+    CHANGING_TASK: RobotActionChangingTask.duration.n,
+    MINING_FOO: RobotActionMiningFoo.duration.n,
+    ASSEMBLING_FOOBAR: RobotActionAssemblingFoobar.duration.n,
+    SELLING_FOOBARS: RobotActionSellingFoobars.duration.n,
+    BUY_NEW_ROBOT: RobotActionBuyNewRobot.duration.n,
+}
+
+
+class Fleet:
+    """Robots as a struct of arrays. Only the first `size` entries are in use."""
+
+    def __init__(self, num_robots: int, capacity: int = 1024):
+        self.size = 0
+        self.op = np.zeros(capacity, dtype=np.int8)
+        self.prev_op = np.zeros(capacity, dtype=np.int8)
+        # task to start once the robot is done changing task, and how long it takes
+        self.next_op = np.zeros(capacity, dtype=np.int8)
+        self.next_duration = np.zeros(capacity, dtype=np.int64)
+        self.deadline = np.zeros(capacity, dtype=np.int64)
+        # payload: foo and bar being assembled, number of foobars being sold
+        self.foo = np.zeros(capacity, dtype=np.int64)
+        self.bar = np.zeros(capacity, dtype=np.int64)
+        self.num_foobars = np.zeros(capacity, dtype=np.int64)
+        self.add_robots(num_robots)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add_robots(self, n: int):
+        new_size = self.size + n
+        if new_size > len(self.op):
+            capacity = max(new_size, 2 * len(self.op))
+            for name in (
+                "op",
+                "prev_op",
+                "next_op",
+                "next_duration",
+                "deadline",
+                "foo",
+                "bar",
+                "num_foobars",
+            ):
+                array = getattr(self, name)
+                grown = np.zeros(capacity, dtype=array.dtype)
+                grown[: self.size] = array[: self.size]
+                setattr(self, name, grown)
+        self.op[self.size : new_size] = IDLE
+        self.prev_op[self.size : new_size] = IDLE
+        self.size = new_size
+
+
+class FleetState:
+    """Simulated world backed by a `Fleet`. Clock and money are plain ints."""
+
+    def __init__(self, rng: Optional[random.Random] = None):
+        self.rng = rng or random.Random()
+        self.clock = 0
+        self.fleet = Fleet(2)  # at the beginning, we have 2 robots
+        self.foo_ctr = 0
+        # foos and foobars are taken from the front, which is O(n) on a list
+        self.foos: Deque[int] = deque()
+        self.bar_ctr = 0
+        self.bars: List[int] = []
+        self.foobars: Deque[Tuple[int, int]] = deque()
+        self.money = 0
+
+
+def run_fleet(state: FleetState, target_robots: int = 30) -> FleetState:
+    """Run the simulation until we have `target_robots` robots.
+
+    Like `main.run_events`, this jumps from one action completion to the next.
+    """
+    fleet = state.fleet
+    while True:
+        state = dispatch_fleet_actions(state)
+        if len(fleet) >= target_robots:
+            return state
+        # every robot is busy now, actions that take no time complete on the next tick
+        state.clock = max(int(fleet.deadline[: fleet.size].min()), state.clock + 1)
+        state = update_fleet_actions_progress(state)
+
+
+def update_fleet_actions_progress(state: FleetState) -> FleetState:
+    fleet = state.fleet
+    op = fleet.op[: fleet.size]
+    deadline = fleet.deadline[: fleet.size]
+    # Robots done moving start their next task, which may complete in the same tick
+    switching = np.flatnonzero((op == CHANGING_TASK) & (deadline <= state.clock))
+    op[switching] = fleet.next_op[switching]
+    deadline[switching] = state.clock + fleet.next_duration[switching]
+    done = np.flatnonzero((op > CHANGING_TASK) & (deadline <= state.clock))
+    if not done.size:
+        return state
+    done_op = op[done]
+
+    mined_foos = int(np.count_nonzero(done_op == MINING_FOO))
+    state.foos.extend(range(state.foo_ctr + 1, state.foo_ctr + mined_foos + 1))
+    state.foo_ctr += mined_foos
+
+    # Draw assembly outcomes in robot order, like `main.assemble_foobar` does
+    assembling = done_op == ASSEMBLING_FOOBAR
+    chance = RobotActionAssemblingFoobar.success_chance
+    success = np.zeros(len(done), dtype=bool)
+    draws = [state.rng.random() for _ in range(np.count_nonzero(assembling))]
+    success[assembling] = np.less(draws, chance)
+    assembled = done[success]
+    state.foobars.extend(
+        zip(fleet.foo[assembled].tolist(), fleet.bar[assembled].tolist())
+    )
+
+    # Mined bars and bars recovered from failed assemblies go back in robot order
+    mining_bar = done_op == MINING_BAR
+    returned = mining_bar | (assembling & ~success)
+    serials = state.bar_ctr + np.cumsum(mining_bar)
+    bars = np.where(mining_bar, serials, fleet.bar[done])[returned]
+    state.bars.extend(bars.tolist())
+    state.bar_ctr += int(np.count_nonzero(mining_bar))
+
+    state.money += int(fleet.num_foobars[done[done_op == SELLING_FOOBARS]].sum())
+
+    fleet.prev_op[done] = done_op
+    op[done] = IDLE
+    fleet.add_robots(int(np.count_nonzero(done_op == BUY_NEW_ROBOT)))
+    return state
+
+
+def dispatch_fleet_actions(state: FleetState) -> FleetState:
+    """Give every idle robot something to do, following `main.dispatch_robot_actions`."""
+    fleet = state.fleet
+    op = fleet.op[: fleet.size]
+    idle = np.flatnonzero(op == IDLE)
+    if not idle.size:
+        return state
+    # Idle robots by previous action, to know which robots can do an action without moving
+    idle_by_prev = np.bincount(fleet.prev_op[idle], minlength=NUM_OPS).tolist()
+    # Busy robots by action they are or will be doing, to see what resources will be available
+    planned = np.where(op == CHANGING_TASK, fleet.next_op[: fleet.size], op)
+    planned_by_op = np.bincount(planned, minlength=NUM_OPS).tolist()
+    buying = int(np.count_nonzero(op == BUY_NEW_ROBOT))
+
+    def should_do(prev: int, action: int) -> bool:
+        # Can I do it efficiently?
+        if prev == action:
+            return True
+        # Can other robots do it for me?
+        return not (idle_by_prev[action] or (action == BUY_NEW_ROBOT and buying))
+
+    def start(robot: int, prev: int, action: int, duration: int):
+        nonlocal buying
+        idle_by_prev[prev] -= 1
+        planned_by_op[action] += 1
+        if prev == action:
+            op[robot] = action
+            fleet.deadline[robot] = state.clock + duration
+            if action == BUY_NEW_ROBOT:
+                buying += 1
+        else:
+            op[robot] = CHANGING_TASK
+            fleet.next_op[robot] = action
+            fleet.next_duration[robot] = duration
+            fleet.deadline[robot] = state.clock + DURATIONS[CHANGING_TASK]
+
+    cost = RobotActionBuyNewRobot.cost.n
+    foos_required = RobotActionBuyNewRobot.foos_required
+    max_foobars = RobotActionSellingFoobars.max_foobars
+    failure_chance = 1 - RobotActionAssemblingFoobar.success_chance
+    for robot, prev in zip(idle.tolist(), fleet.prev_op[idle].tolist()):
+        # Prioritize buying more robots whenever possible
+        if (
+            state.money >= cost
+            and len(state.foos) > foos_required
+            and should_do(prev, BUY_NEW_ROBOT)
+        ):
+            state.money -= cost
+            for _ in range(foos_required):
+                state.foos.popleft()
+            start(robot, prev, BUY_NEW_ROBOT, DURATIONS[BUY_NEW_ROBOT])
+            continue
+        # Always sell maximum amount of foobars to save time
+        if (
+            len(state.foobars) >= max_foobars
+            and state.money < cost
+            and should_do(prev, SELLING_FOOBARS)
+        ):
+            for _ in range(max_foobars):
+                state.foobars.popleft()
+            fleet.num_foobars[robot] = max_foobars
+            start(robot, prev, SELLING_FOOBARS, DURATIONS[SELLING_FOOBARS])
+            continue
+        # Assemble foobars if we have surplus resources
+        if (
+            len(state.foobars) < max_foobars
+            and len(state.foos) > foos_required
+            and len(state.bars) > 0
+            and should_do(prev, ASSEMBLING_FOOBAR)
+        ):
+            fleet.foo[robot] = state.foos.pop()
+            fleet.bar[robot] = state.bars.pop()
+            start(robot, prev, ASSEMBLING_FOOBAR, DURATIONS[ASSEMBLING_FOOBAR])
+            continue
+        # Mine foos/bars based on which we need more of
+        num_foos = len(state.foos) + planned_by_op[MINING_FOO]
+        num_bars = (
+            len(state.bars)
+            + planned_by_op[MINING_BAR]
+            + planned_by_op[ASSEMBLING_FOOBAR] * failure_chance
+        )
+        if abs(num_foos - num_bars - foos_required) < TIE_TOLERANCE:
+            num_bars = bars_in_robot_order(state)
+        if num_foos - num_bars < foos_required and should_do(prev, MINING_FOO):
+            start(robot, prev, MINING_FOO, DURATIONS[MINING_FOO])
+        else:
+            duration = round(state.rng.random() * 15) + 5
+            start(robot, prev, MINING_BAR, duration)
+    return state
+
+
+def bars_in_robot_order(state: FleetState) -> float:
+    """Return the expected number of bars like `main.expected_in_robot_order` does."""
+    fleet = state.fleet
+    op = fleet.op[: fleet.size]
+    planned = np.where(op == CHANGING_TASK, fleet.next_op[: fleet.size], op)
+    failure_chance = 1 - RobotActionAssemblingFoobar.success_chance
+    num_bars = len(state.bars)
+    for action in planned[(planned == MINING_BAR) | (planned == ASSEMBLING_FOOBAR)]:
+        num_bars += 1 if action == MINING_BAR else failure_chance
+    return num_bars
+
+
+def log_fleet_state(state: FleetState, log: Log):
+    log.write(
+        "| "
+        + " | ".join(
+            [
+                f"time:\t{Time(state.clock)}",
+                f"robots:\t{len(state.fleet)}",
+                f"foos:\t{len(state.foos)}",
+                f"bars:\t{len(state.bars)}",
+                f"foobars:\t{len(state.foobars)}",
+                f"money:\t{state.money}€",
+            ]
+        )
+    )
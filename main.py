@@ -2,14 +2,37 @@
 
 from __future__ import annotations
 
+import argparse
+import copy
+import hashlib
 import random
-from typing import List, Optional, Type
+import sys
+from collections import deque
+from enum import IntEnum
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Protocol,
+    Set,
+    TextIO,
+    Tuple,
+    Union,
+)
+
+from profiler import PHASES, PhaseProfiler
+from tracefile import Task, TraceEvent, TraceWriter
 from abc import ABCMeta
 
 
 class Time:
     """Time is a unit of simulation steps. One step is 100ms"""
 
+    __slots__ = ("n",)
+
     def __init__(self, n):
         self.n = n
 
@@ -19,6 +42,9 @@ class Time:
     def __gt__(self, other: Time):
         return self.n.__gt__(other.n)
 
+    def __ge__(self, other: Time):
+        return self.n.__ge__(other.n)
+
     def __eq__(self, other: Time):
         return self.n.__eq__(other.n)
 
@@ -28,16 +54,58 @@ class Time:
     def increment(self):
         self.n += 1
 
-    def decrement(self):
-        self.n -= 1
-
     def as_seconds(self) -> float:
         return float(self.n) / 10
 
 
+class LogLevel(IntEnum):
+    OFF = 0
+    SUMMARY = 1  # only the outcome of the simulation
+    TICK = 2  # also the state after each tick
+    EVENT = 3  # also what each robot does
+
+
+class Log:
+    """Simulation output, filtered by level and written in large chunks.
+
+    Callers check the level flags before formatting anything, so disabled levels cost a single
+    attribute lookup.
+    """
+
+    def __init__(
+        self,
+        level: LogLevel = LogLevel.EVENT,
+        out: Optional[TextIO] = None,
+        buffer_size=1 << 16,
+    ):
+        self.summary = level >= LogLevel.SUMMARY
+        self.ticks = level >= LogLevel.TICK
+        self.events = level >= LogLevel.EVENT
+        self.out = out or sys.stdout
+        self.buffer_size = buffer_size
+        self.lines: List[str] = []
+        self.buffered = 0
+
+    def write(self, line: str):
+        self.lines.append(line)
+        self.buffered += len(line)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            self.lines.append("")
+            self.out.write("\n".join(self.lines))
+            self.lines = []
+            self.buffered = 0
+        self.out.flush()
+
+
 class Foo(int):
     """Each foo must have a unique serial number."""
 
+    __slots__ = ()
+
     def __repr__(self) -> str:
         return f"foo_{int(self)}"
 
@@ -45,11 +113,15 @@ class Foo(int):
 class Bar(int):
     """Each bar must have a unique serial number."""
 
+    __slots__ = ()
+
     def __repr__(self) -> str:
         return f"bar_{int(self)}"
 
 
 class Foobar:
+    __slots__ = ("foo", "bar")
+
     def __init__(self, foo: Foo, bar: Bar):
         self.foo = foo
         self.bar = bar
@@ -58,9 +130,38 @@ class Foobar:
         return f"foobar_{int(self.foo)}_{int(self.bar)}"
 
 
+class Stock:
+    """Inventory which only counts its items, for runs which don't need to know which ones we have.
+
+    It can stand in for the deques holding foos, bars and foobars: items put in it are dropped and
+    items taken from it are `None`, so its memory doesn't grow with the number of items.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def append(self, item):
+        self.count += 1
+
+    def pop(self) -> None:
+        if not self.count:
+            raise IndexError("pop from an empty stock")
+        self.count -= 1
+
+    popleft = pop
+
+
+Inventory = Union[Deque, Stock]
+
+
 class Money:
     """Money is a unit of currency in the simulation."""
 
+    __slots__ = ("n",)
+
     def __init__(self, n):
         self.n = n
 
@@ -86,43 +187,89 @@ class Money:
         self.n -= other.n
 
 
+# Action opcodes, used to look up what to do with an action in tables instead of checking its
+# class. The opcodes of tasks are the `tracefile.Task` codes, so that traces can record them as is,
+# and `fleet.py` stores them in arrays.
+IDLE = 0
+CHANGING_TASK = 1
+MINING_FOO = int(Task.MINING_FOO)
+MINING_BAR = int(Task.MINING_BAR)
+ASSEMBLING_FOOBAR = int(Task.ASSEMBLING_FOOBAR)
+SELLING_FOOBARS = int(Task.SELLING_FOOBARS)
+BUY_NEW_ROBOT = int(Task.BUY_NEW_ROBOT)
+NUM_OPS = BUY_NEW_ROBOT + 1
+
+
 class RobotAction(metaclass=ABCMeta):
     """Base class for all robot actions."""
 
-    remaining_time = Time(0)
+    __slots__ = ("finishes_at",)
+
+    opcode: int
+    duration: Time
+    # tick at which the action is finished, set when the robot starts it
+    finishes_at: int
 
     def __repr__(self) -> str:
         return type(self).__name__
 
+    def start(self, clock: Time):
+        self.finishes_at = clock.n + self.duration.n
+
 
 class RobotActionIdle(RobotAction):
-    """The robot has nothing to do."""
+    """The robot has nothing to do.
+
+    Idle actions only remember the opcode of the previous action, `IDLE` if there was none, so
+    they are shared: use `IDLE_AFTER` instead of creating them.
+    """
+
+    __slots__ = ("prev_op",)
+
+    opcode = IDLE
+
+    def __init__(self, prev_op: int):
+        self.prev_op = prev_op
+
 
-    def __init__(self, prev_action: Optional[RobotAction]):
-        self.prev_action = prev_action
+# idle action of robots which just finished an action, by opcode of that action
+IDLE_AFTER = [RobotActionIdle(op) for op in range(NUM_OPS)]
 
 
 class RobotActionChangingTask(RobotAction):
     """Moving to change activity: occupy the robot for 5 seconds."""
 
+    __slots__ = ("next_task",)
+
+    opcode = CHANGING_TASK
+    duration = Time(50)
+
     def __init__(self, next_task: RobotAction):
-        self.remaining_time = Time(50)
         self.next_task = next_task
 
 
 class RobotActionMiningFoo(RobotAction):
     """Mining foo: occupies the robot for 1 second."""
 
-    def __init__(self):
-        self.remaining_time = Time(10)
+    __slots__ = ()
+
+    opcode = MINING_FOO
+    duration = Time(10)
 
 
 class RobotActionMiningBar(RobotAction):
     """Mining bar: keeps the robot busy for a random time between 0.5 and 2 seconds."""
 
-    def __init__(self):
-        random_ticks = round(random.random() * 15)
-        self.remaining_time = Time(random_ticks + 5)
+    __slots__ = ("duration",)
+
+    opcode = MINING_BAR
+
+    def __init__(self, rng: random.Random):
+        self.duration = BAR_DURATIONS[round(rng.random() * 15)]
+
+
+# durations of mining a bar, shared by actions since they never change
+BAR_DURATIONS = [Time(random_ticks + 5) for random_ticks in range(16)]
 
 
 class RobotActionAssemblingFoobar(RobotAction):
@@ -131,36 +278,43 @@ class RobotActionAssemblingFoobar(RobotAction):
     The operation has a 60% chance of success.
     """
 
+    __slots__ = ("foo", "bar")
+
+    opcode = ASSEMBLING_FOOBAR
     success_chance = 0.6
+    duration = Time(20)
 
     def __init__(self, foo: Foo, bar: Bar):
         self.foo = foo
         self.bar = bar
-        self.remaining_time = Time(20)
 
 
 class RobotActionSellingFoobars(RobotAction):
     """Sell foobar: 10s to sell from 1 to 5 foobar."""
 
+    __slots__ = ("foobars", "profit")
+
+    opcode = SELLING_FOOBARS
     max_foobars = 5
+    duration = Time(100)
 
     def __init__(self, foobars: List[Foobar]):
         if len(foobars) > self.max_foobars:
             raise ValueError(f"Cannot sell more than {self.max_foobars} foobars.")
         self.foobars = foobars
-        self.remaining_time = Time(100)
-
-    @property
-    def profit(self):
         # we earn €1 per foobar sold
-        return Money(len(self.foobars))
+        self.profit = Money(len(foobars))
 
 
 class RobotActionBuyNewRobot(RobotAction):
     """Buy a new robot for €3 and 6 foo, 0s"""
 
+    __slots__ = ("foos",)
+
+    opcode = BUY_NEW_ROBOT
     cost = Money(3)
     foos_required = 6
+    duration = Time(0)
 
     def __init__(self, foos: List[Foo]):
         if len(foos) != self.foos_required:
@@ -168,33 +322,296 @@ class RobotActionBuyNewRobot(RobotAction):
         self.foos = foos
 
 
+class Rules(NamedTuple):
+    """Parameters of the simulation, which variants of a world may change, see `State.fork`."""
+
+    robot_cost: Money = RobotActionBuyNewRobot.cost
+    success_chance: float = RobotActionAssemblingFoobar.success_chance
+    # decides what idle robots do, `DefaultPolicy` if None
+    policy: Optional[DispatchPolicy] = None
+
+
+def expected_yields(rules: Rules) -> List[Tuple[float, float, float]]:
+    """Return the expected number of foos, bars and foobars each action yields, by opcode."""
+    yields = [(0, 0, 0)] * NUM_OPS
+    yields[MINING_FOO] = (1, 0, 0)
+    yields[MINING_BAR] = (0, 1, 0)
+    # in case of failure the bar can be reused
+    yields[ASSEMBLING_FOOBAR] = (0, 1 - rules.success_chance, rules.success_chance)
+    return yields
+
+
 class Robot:
+    __slots__ = ("id", "action")
+
     action: RobotAction
 
-    def __init__(self):
-        self.action = RobotActionIdle(None)
+    def __init__(self, id: int):
+        self.id = id
+        self.action = IDLE_AFTER[IDLE]
 
-    def set_action(self, action: RobotAction):
-        if self.action.remaining_time > Time(0):
+    def set_action(self, action: RobotAction, clock: Time):
+        if self.action.opcode != IDLE:
             raise ValueError("This robot is busy and cannot do this action.")
-        if robot_did_this_action_recently(self, type(action)):
+        if robot_did_this_action_recently(self, action.opcode):
             self.action = action
         else:
             self.action = RobotActionChangingTask(action)
+        self.action.start(clock)
+
+
+class TimerWheel:
+    """Ids of busy robots, bucketed by the tick at which their action finishes.
+
+    No action takes longer than `size` ticks, so a bucket only ever holds robots finishing at the
+    same tick, and finding who finishes at a given tick doesn't depend on how many robots we have.
+    """
+
+    def __init__(self, size: int = 128):
+        self.buckets: List[List[int]] = [[] for _ in range(size)]
+        self.size = size
+
+    def schedule(self, robot_id: int, tick: int, clock: Time):
+        if not clock.n < tick <= clock.n + self.size:
+            raise ValueError(f"Cannot schedule tick {tick} at {clock}.")
+        self.buckets[tick % self.size].append(robot_id)
+
+    def pop(self, tick: int) -> List[int]:
+        """Remove and return robots finishing at `tick`, in robot order."""
+        bucket = self.buckets[tick % self.size]
+        self.buckets[tick % self.size] = []
+        bucket.sort()
+        return bucket
+
+    def scheduled(self, clock: Time) -> Dict[int, int]:
+        """Return the tick at which each busy robot finishes, from `clock` on."""
+        return {
+            robot_id: clock.n + (i - clock.n) % self.size
+            for i, bucket in enumerate(self.buckets)
+            for robot_id in bucket
+        }
+
+    def next_tick(self, clock: Time) -> int:
+        """Return the next tick at which a robot finishes."""
+        for tick in range(clock.n + 1, clock.n + self.size + 1):
+            if self.buckets[tick % self.size]:
+                return tick
+        raise ValueError("No robot is busy.")
+
+
+class Metrics:
+    """Counts of what robots did, which dispatching is tuned against."""
+
+    __slots__ = (
+        "finished_actions",
+        "task_changes",
+        "task_change_ticks",
+        "bars_mined_by_default",
+        "buying_blocked_by_money",
+        "buying_blocked_by_foos",
+    )
+
+    def __init__(self):
+        # number of actions robots finished
+        self.finished_actions = 0
+        # how often robots had to move to start an action, and robot-ticks spent moving
+        self.task_changes = 0
+        self.task_change_ticks = 0
+        # dispatches to mining bars because no other action was chosen
+        self.bars_mined_by_default = 0
+        # ticks with idle robots in which we could not afford a new robot for lack of money or
+        # foos, a tick can count for both
+        self.buying_blocked_by_money = 0
+        self.buying_blocked_by_foos = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return {name: getattr(self, name) for name in self.__slots__}
 
 
 class State:
     """State describes the simulated world."""
 
-    def __init__(self):
+    def __init__(
+        self,
+        rng: Optional[random.Random] = None,
+        log: Optional[Log] = None,
+        trace: Optional[TraceWriter] = None,
+        lineage: bool = True,
+        profiler: Optional[PhaseProfiler] = None,
+        rules: Optional[Rules] = None,
+        crn: Optional[CommonRandomNumbers] = None,
+    ):
+        # every random draw of the simulation comes from this generator, unless it has common
+        # random numbers
+        self.rng = rng or random.Random()
+        self.crn = crn
+        self.log = log or Log(LogLevel.OFF)
+        self.trace = trace
+        self.profiler = profiler
+        self.lineage = lineage
+        if not lineage and (self.log.events or trace):
+            raise ValueError("Event logs and traces need to know which items we have.")
+        self.rules = rules or Rules()
+        self.yields = expected_yields(self.rules)
         self.clock = Time(0)
-        self.robots = [Robot(), Robot()]  # at the beginning, we have 2 robots
+        self.robots = [Robot(0), Robot(1)]  # at the beginning, we have 2 robots
+        self.idle_robots: Set[int] = {0, 1}
+        self.timers = TimerWheel()
         self.foo_ctr = 0
-        self.foos = []
+        # Inventories are taken from both ends, deques make that O(1). Without lineage we only
+        # count items, which keeps memory flat however many we mine.
+        self.foos: Inventory = deque() if lineage else Stock()
         self.bar_ctr = 0
-        self.bars = []
-        self.foobars = []
+        self.bars: Inventory = deque() if lineage else Stock()
+        self.foobars: Inventory = deque() if lineage else Stock()
         self.money = Money(0)
+        # Actions that busy robots are doing or moving to do, by opcode, and what they will sell
+        # for. `FutureState` reads them instead of looking at every robot.
+        self.planned_actions = [0] * NUM_OPS
+        self.planned_profit = Money(0)
+        # Ids of robots which did each action recently, by opcode, as defined by
+        # `robot_did_this_action_recently`, so we don't have to ask every robot.
+        self.recent_robots: List[Set[int]] = [set() for _ in range(NUM_OPS)]
+        # highest inventories and money seen so far
+        self.peak_foos = 0
+        self.peak_bars = 0
+        self.peak_foobars = 0
+        self.peak_money = Money(0)
+        self.metrics = Metrics()
+
+    def record_peaks(self):
+        self.peak_foos = max(self.peak_foos, len(self.foos))
+        self.peak_bars = max(self.peak_bars, len(self.bars))
+        self.peak_foobars = max(self.peak_foobars, len(self.foobars))
+        if self.money > self.peak_money:
+            self.peak_money = Money(self.money.n)
+
+    def rng_for(self, robot: Robot, op: int) -> Union[random.Random, CounterRandom]:
+        """Return the generator to use for a random draw of `robot` about action `op`."""
+        if self.crn is None:
+            return self.rng
+        return self.crn.stream(robot.id, op)
+
+    def fork(
+        self,
+        rules: Optional[Rules] = None,
+        log: Optional[Log] = None,
+        trace: Optional[TraceWriter] = None,
+        profiler: Optional[PhaseProfiler] = None,
+    ) -> State:
+        """Return a copy of the world which carries on independently, with the same random
+        streams, under `rules` if given.
+
+        Items and the payloads of actions are never changed once created, so the copy shares
+        them, and only copies the containers and robots. Robots changing task set the deadline of
+        their next task when they get to it, so theirs are copied.
+        """
+        world = State(
+            log=log,
+            trace=trace,
+            lineage=self.lineage,
+            profiler=profiler,
+            rules=rules or self.rules,
+            crn=self.crn.copy() if self.crn else None,
+        )
+        world.rng.setstate(self.rng.getstate())
+        world.clock = Time(self.clock.n)
+        world.robots = [Robot(robot.id) for robot in self.robots]
+        for robot, original in zip(world.robots, self.robots):
+            robot.action = original.action
+            if robot.action.opcode == CHANGING_TASK:
+                robot.action = copy.copy(robot.action)
+                robot.action.next_task = copy.copy(robot.action.next_task)
+        world.idle_robots = set(self.idle_robots)
+        world.timers.buckets = [list(bucket) for bucket in self.timers.buckets]
+        world.foo_ctr = self.foo_ctr
+        world.bar_ctr = self.bar_ctr
+        for name in ("foos", "bars", "foobars"):
+            inventory = getattr(self, name)
+            if self.lineage:
+                getattr(world, name).extend(inventory)
+            else:
+                getattr(world, name).count = len(inventory)
+        world.money = Money(self.money.n)
+        world.planned_actions = list(self.planned_actions)
+        world.planned_profit = Money(self.planned_profit.n)
+        world.recent_robots = [set(robots) for robots in self.recent_robots]
+        world.peak_foos = self.peak_foos
+        world.peak_bars = self.peak_bars
+        world.peak_foobars = self.peak_foobars
+        world.peak_money = Money(self.peak_money.n)
+        world.metrics = copy.copy(self.metrics)
+        return world
+
+
+def spawn_rng(seed: int, n: int) -> random.Random:
+    """Return the n-th child generator of `seed`.
+
+    Children only depend on `seed` and `n`, so run n of a batch gets the same stream no matter
+    how many runs there are or which worker runs it.
+    """
+    return random.Random(spawn_seed(seed, n))
+
+
+def spawn_seed(seed: int, n: Union[int, str]) -> int:
+    digest = hashlib.blake2b(f"{seed}/{n}".encode(), digest_size=16).digest()
+    return int.from_bytes(digest, "big")
+
+
+class CounterRandom:
+    """Random stream whose n-th draw is a SplitMix64 hash of its key and n.
+
+    The whole stream is its key and number of draws, so it is small, and restoring it only sets
+    the count. A `random.Random` per stream would be about 3 KB and have to replay its draws.
+    """
+
+    __slots__ = ("key", "draws")
+
+    def __init__(self, key: int, draws: int = 0):
+        self.key = key
+        self.draws = draws
+
+    def random(self) -> float:
+        self.draws += 1
+        z = (self.key + self.draws * 0x9E3779B97F4A7C15) & MASK_64
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK_64
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK_64
+        # 53 random bits, like `random.Random.random`
+        return ((z ^ (z >> 31)) >> 11) * RANDOM_SCALE
+
+
+MASK_64 = (1 << 64) - 1
+RANDOM_SCALE = 2.0**-53
+
+
+class CommonRandomNumbers:
+    """Random streams dedicated to each robot and action, for comparing dispatch policies.
+
+    With a single generator, one different decision shifts all later draws, so two policies run
+    with the same seed soon see different luck. With these streams, the n-th bar a robot mines or
+    the n-th foobar it assembles gets the same draw whatever the policy.
+    """
+
+    def __init__(self, seed: int):
+        self.seed = seed
+        self.streams: Dict[Tuple[int, int], CounterRandom] = {}
+
+    def stream(self, robot_id: int, op: int) -> CounterRandom:
+        stream = self.streams.get((robot_id, op))
+        if stream is None:
+            stream = CounterRandom(spawn_seed(self.seed, f"{robot_id}/{op}") & MASK_64)
+            self.streams[(robot_id, op)] = stream
+        return stream
+
+    def restore(self, robot_id: int, op: int, draws: int):
+        """Bring a stream back to where it was after `draws` draws."""
+        self.stream(robot_id, op).draws = draws
+
+    def copy(self) -> CommonRandomNumbers:
+        crn = CommonRandomNumbers(self.seed)
+        for key, stream in self.streams.items():
+            crn.streams[key] = CounterRandom(stream.key, stream.draws)
+        return crn
 
 
 class FutureState:
@@ -204,195 +621,585 @@ class FutureState:
         self.num_foos = len(state.foos)
         self.num_bars = len(state.bars)
         self.num_foobars = len(state.foobars)
-        self.money = Money(state.money.n)
-        for robot in state.robots:
-            action = robot.action
-            if isinstance(action, RobotActionChangingTask):
-                action = action.next_task
-            if isinstance(action, RobotActionMiningFoo):
-                self.num_foos += 1
-            elif isinstance(action, RobotActionMiningBar):
-                self.num_bars += 1
-            elif isinstance(action, RobotActionAssemblingFoobar):
-                self.num_foobars += action.success_chance
-                self.num_bars += 1 - action.success_chance
-            elif isinstance(action, RobotActionSellingFoobars):
-                self.money.add(action.profit)
+        self.money = Money(state.money.n + state.planned_profit.n)
+        for n, (foos, bars, foobars) in zip(state.planned_actions, state.yields):
+            if n:
+                self.num_foos += n * foos
+                self.num_bars += n * bars
+                self.num_foobars += n * foobars
+        # Adding the expected outcomes robot by robot rounds them differently. That only changes
+        # which resource we mine next when foos and bars are tied, so sum them like that then.
+        fb_diff = self.num_foos - self.num_bars
+        if abs(fb_diff - RobotActionBuyNewRobot.foos_required) < TIE_TOLERANCE:
+            self.num_bars, self.num_foobars = expected_in_robot_order(state)
+
+
+# Sums of expected outcomes by opcode and by robot differ by far less than this
+TIE_TOLERANCE = 1e-6
+
+
+def expected_in_robot_order(state) -> Tuple[float, float]:
+    """Return the expected number of bars and foobars, adding what each robot yields in order."""
+    num_bars = len(state.bars)
+    num_foobars = len(state.foobars)
+    for robot in state.robots:
+        action = robot.action
+        if action.opcode == CHANGING_TASK:
+            action = action.next_task
+        _, bars, foobars = state.yields[action.opcode]
+        num_bars += bars
+        num_foobars += foobars
+    return num_bars, num_foobars
 
 
 def main():
-    state = State()
+    parser = argparse.ArgumentParser(description="Robots building robots.")
+    parser.add_argument(
+        "--engine",
+        choices=["tick", "event", "fleet"],
+        help="step every 100ms tick (the default), jump straight to the next action completion, "
+        "or store robots in NumPy arrays for very large fleets",
+    )
+    parser.add_argument("--seed", type=int, help="seed for the random generator")
+    parser.add_argument(
+        "--log",
+        choices=[level.name.lower() for level in LogLevel],
+        help="how much to print: nothing, the outcome, the state after each tick, "
+        "or also what each robot does (the default)",
+    )
+    parser.add_argument(
+        "--robots", type=int, default=30, help="stop once we have this many robots"
+    )
+    parser.add_argument(
+        "--trace", help="record every state transition to this binary file"
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        help="time each phase of every tick and write p50, p99 and max durations for every "
+        "1000 ticks to this JSON file",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        metavar="FILE",
+        help="save the simulation to this file every --checkpoint-every seconds",
+    )
+    parser.add_argument(
+        "--checkpoint-every",
+        type=float,
+        default=100,
+        metavar="SECONDS",
+        help="simulated time between checkpoints, defaults to 100s",
+    )
+    parser.add_argument(
+        "--resume",
+        metavar="FILE",
+        help="resume the simulation saved in this checkpoint file, instead of starting anew",
+    )
+    parser.add_argument(
+        "--counts",
+        action="store_true",
+        help="only count foos, bars and foobars instead of keeping each one, so memory stays flat "
+        "on long runs (not with --log event or --trace)",
+    )
+    parser.add_argument(
+        "--worlds",
+        type=int,
+        help="simulate this many independent worlds in lockstep and print the distribution of "
+        "finishing times (requires numpy)",
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        help="run the simulation this many times in parallel and print a summary of the results",
+    )
+    parser.add_argument(
+        "--precision",
+        type=float,
+        metavar="SECONDS",
+        help="run the simulation in parallel until the 95%% confidence interval of the mean "
+        "finishing time is within ±SECONDS, and at most --runs times",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        help="number of worker processes for --runs and --precision, defaults to all cores",
+    )
+    args = parser.parse_args()
+    if args.runs is not None and args.runs < 1:
+        parser.error("--runs must be at least 1")
+    if args.worlds is not None and args.worlds < 1:
+        parser.error("--worlds must be at least 1")
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    # options of a single simulation, which running many of them doesn't use
+    single_run_options = [
+        "--engine",
+        "--log",
+        "--trace",
+        "--profile",
+        "--checkpoint",
+        "--resume",
+        "--counts",
+    ]
+    if args.worlds is not None:
+        reject_options(
+            parser,
+            args,
+            "--worlds",
+            single_run_options + ["--runs", "--precision", "--jobs"],
+        )
+    elif args.runs is not None or args.precision is not None:
+        mode = "--precision" if args.precision is not None else "--runs"
+        reject_options(parser, args, mode, single_run_options)
+    elif args.jobs is not None:
+        parser.error("--jobs is only used with --runs and --precision")
+    if args.runs is not None or args.precision is not None or args.worlds is not None:
+        # a batch is only reproducible if we know its seed
+        seed = random.getrandbits(64) if args.seed is None else args.seed
+    if args.precision is not None:
+        import batch
+
+        if args.precision <= 0:
+            parser.error("--precision must be positive")
+        results = batch.run_until_precise(
+            args.precision,
+            args.jobs,
+            seed,
+            args.robots,
+            max_runs=args.runs or batch.MAX_RUNS,
+        )
+        batch.log_batch_summary(results, seed)
+        return
+    if args.runs is not None:
+        import batch
+
+        results = batch.run_batch(args.runs, args.jobs, seed, args.robots)
+        batch.log_batch_summary(results, seed)
+        return
+    if args.worlds is not None:
+        import montecarlo
+
+        finish_ticks = montecarlo.simulate_worlds(args.worlds, seed, args.robots)
+        montecarlo.log_finish_times(finish_ticks, seed)
+        return
+    rng = random.Random(args.seed)
+    log = Log(LogLevel[(args.log or "event").upper()])
+    if args.engine == "fleet":
+        import fleet
+
+        reject_options(
+            parser,
+            args,
+            "--engine fleet",
+            ["--trace", "--profile", "--checkpoint", "--resume", "--counts"],
+        )
+
+        fleet_state = fleet.run_fleet(fleet.FleetState(rng), args.robots)
+        if log.ticks:
+            fleet.log_fleet_state(fleet_state, log)
+        if log.summary:
+            log.write(
+                f"Finished with {len(fleet_state.fleet)} robots in {Time(fleet_state.clock)}."
+            )
+        log.flush()
+        return
+    if args.counts and (log.events or args.trace):
+        parser.error("--counts cannot be used with --log event or --trace")
+    trace = TraceWriter.open(args.trace) if args.trace else None
+    profiler = PhaseProfiler() if args.profile else None
+    if args.resume:
+        import checkpoint
+
+        try:
+            state = checkpoint.load(args.resume, log, trace, profiler)
+        except (OSError, ValueError) as e:
+            parser.error(f"cannot resume from {args.resume}: {e}")
+    else:
+        state = State(rng, log, trace, lineage=not args.counts, profiler=profiler)
+    run = run_events if args.engine == "event" else run_ticks
+    if args.checkpoint:
+        import checkpoint
+
+        every = max(1, round(args.checkpoint_every * 10))
+        while True:
+            state = run(state, args.robots, until=state.clock.n + every)
+            if len(state.robots) >= args.robots:
+                break
+            # what happened up to the checkpoint must not be lost if we are stopped after it
+            log.flush()
+            if trace:
+                trace.flush()
+            checkpoint.save(state, args.checkpoint)
+    else:
+        state = run(state, args.robots)
+    if log.summary:
+        log.write(f"Finished with {len(state.robots)} robots in {state.clock}.")
+        log_metrics(state)
+    log.flush()
+    if trace:
+        trace.close()
+    if profiler:
+        profiler.write(args.profile)
+
+
+def reject_options(
+    parser: argparse.ArgumentParser,
+    args: argparse.Namespace,
+    mode: str,
+    options: List[str],
+):
+    """Exit with an error if any of `options` was given, as `mode` doesn't use them."""
+    given = [
+        option
+        for option in options
+        if getattr(args, option[2:].replace("-", "_")) not in (None, False)
+    ]
+    if given:
+        parser.error(f"{mode} cannot be used with {', '.join(given)}")
+
+
+def run_ticks(
+    state: State, target_robots: int = 30, until: Optional[int] = None
+) -> State:
+    """Run the simulation one tick at a time until we have `target_robots` robots.
+
+    With `until`, also stop before running that tick.
+    """
+    update, dispatch, log = loop_phases(state)
     while True:
-        state = update_robot_actions_progress(state)
-        state = dispatch_robot_actions(state)
-        log_state(state)
-        if len(state.robots) >= 30:
-            print(f"Finished with {len(state.robots)} robots in {state.clock}.")
-            break
+        state = update(state)
+        state = dispatch(state)
+        if state.log.ticks:
+            log(state)
+        if len(state.robots) >= target_robots:
+            return state
         state.clock.increment()
+        if until is not None and state.clock.n >= until:
+            return state
+
+
+def run_events(
+    state: State, target_robots: int = 30, until: Optional[int] = None
+) -> State:
+    """Run the simulation until we have `target_robots` robots, skipping ticks where nothing
+    happens.
+
+    Every idle robot is given something to do by `dispatch_robot_actions`, so nothing can change
+    between two action completions. We jump to the next tick found on the timer wheel, which
+    gives the same results as `run_ticks`. With `until`, also stop before running the first tick
+    at or after it.
+    """
+    update, dispatch, log = loop_phases(state)
+    while True:
+        state = update(state)
+        state = dispatch(state)
+        if state.log.ticks:
+            log(state)
+        if len(state.robots) >= target_robots:
+            return state
+        state.clock.n = state.timers.next_tick(state.clock)
+        if until is not None and state.clock.n >= until:
+            return state
+
+
+def loop_phases(state: State) -> List[Callable[[State], Optional[State]]]:
+    """Return the functions which update, dispatch and log the state on each tick.
+
+    They are timed if the state has a profiler, which is decided once here rather than on every
+    tick.
+    """
+    phases = [update_robot_actions_progress, dispatch_robot_actions, log_state]
+    if state.profiler:
+        return [state.profiler.timed(name, f) for name, f in zip(PHASES, phases)]
+    return phases
 
 
 def update_robot_actions_progress(state: State) -> State:
-    for robot in state.robots:
-        robot.action.remaining_time.decrement()
-        if robot.action.remaining_time > Time(0):
-            continue
-        # Action is finished
-        if isinstance(robot.action, RobotActionChangingTask):
-            robot.action = robot.action.next_task
-            # Need to check remaining time again, for example buying a new robot takes 0s to complete
-            # so we can perform it in the same tick
-            if robot.action.remaining_time > Time(0):
-                continue
-        if isinstance(robot.action, RobotActionMiningFoo):
-            state = mine_foo(state)
-            robot.action = RobotActionIdle(robot.action)
-        elif isinstance(robot.action, RobotActionMiningBar):
-            state = mine_bar(state)
-            robot.action = RobotActionIdle(robot.action)
-        elif isinstance(robot.action, RobotActionAssemblingFoobar):
-            state = assemble_foobar(state, robot.action)
-            robot.action = RobotActionIdle(robot.action)
-        elif isinstance(robot.action, RobotActionSellingFoobars):
-            state = sell_foobars(state, robot.action)
-            robot.action = RobotActionIdle(robot.action)
-        elif isinstance(robot.action, RobotActionBuyNewRobot):
-            state = buy_new_robot(state, robot.action)
-            robot.action = RobotActionIdle(robot.action)
+    for robot_id in state.timers.pop(state.clock.n):
+        state = finish_robot_action(state, state.robots[robot_id])
     return state
 
 
-def mine_foo(state: State) -> State:
+def finish_robot_action(state: State, robot: Robot) -> State:
+    if robot.action.opcode == CHANGING_TASK:
+        state.metrics.task_change_ticks += robot.action.duration.n
+        robot.action = robot.action.next_task
+        robot.action.start(state.clock)
+        if robot.action.opcode == BUY_NEW_ROBOT:
+            state.recent_robots[BUY_NEW_ROBOT].add(robot.id)
+        # Need to check the deadline again, for example buying a new robot takes 0s to complete
+        # so we can perform it in the same tick
+        if robot.action.finishes_at > state.clock.n:
+            state.timers.schedule(robot.id, robot.action.finishes_at, state.clock)
+            return state
+    action = robot.action
+    state.planned_actions[action.opcode] -= 1
+    # the robot will be idle after this action
+    state.recent_robots[action.opcode].add(robot.id)
+    state.idle_robots.add(robot.id)
+    state.metrics.finished_actions += 1
+    state = FINISH_HANDLERS[action.opcode](state, robot, action)
+    robot.action = IDLE_AFTER[action.opcode]
+    state.record_peaks()
+    return state
+
+
+def mine_foo(state: State, robot: Robot, action: RobotActionMiningFoo) -> State:
     state.foo_ctr += 1
     foo = Foo(state.foo_ctr)
     state.foos.append(foo)
-    print(f"mined {foo}")
+    if state.trace:
+        state.trace.record(state.clock.n, robot.id, TraceEvent.MINED_FOO, a=foo)
+    if state.log.events:
+        state.log.write(f"mined {foo}")
     return state
 
 
-def mine_bar(state: State) -> State:
+def mine_bar(state: State, robot: Robot, action: RobotActionMiningBar) -> State:
     state.bar_ctr += 1
     bar = Bar(state.bar_ctr)
     state.bars.append(bar)
-    print(f"mined {bar}")
+    if state.trace:
+        state.trace.record(state.clock.n, robot.id, TraceEvent.MINED_BAR, a=bar)
+    if state.log.events:
+        state.log.write(f"mined {bar}")
     return state
 
 
-def assemble_foobar(state: State, action: RobotActionAssemblingFoobar) -> State:
-    if random.random() < action.success_chance:
+def assemble_foobar(
+    state: State, robot: Robot, action: RobotActionAssemblingFoobar
+) -> State:
+    if state.rng_for(robot, ASSEMBLING_FOOBAR).random() < state.rules.success_chance:
         foobar = Foobar(action.foo, action.bar)
-        print(f"assembled {foobar}")
+        if state.trace:
+            state.trace.record(
+                state.clock.n,
+                robot.id,
+                TraceEvent.ASSEMBLED,
+                a=action.foo,
+                b=action.bar,
+            )
+        if state.log.events:
+            state.log.write(f"assembled {foobar}")
         state.foobars.append(foobar)
     else:
         # in case of failure the bar can be reused, the foo is lost.
-        print(f"assembling foobar failed, recovered {action.bar}")
+        if state.trace:
+            state.trace.record(
+                state.clock.n,
+                robot.id,
+                TraceEvent.ASSEMBLY_FAILED,
+                a=action.foo,
+                b=action.bar,
+            )
+        if state.log.events:
+            state.log.write(f"assembling foobar failed, recovered {action.bar}")
         state.bars.append(action.bar)
     return state
 
 
-def sell_foobars(state: State, action: RobotActionSellingFoobars) -> State:
-    print(f"sold {action.foobars} for {action.profit}")
+def sell_foobars(
+    state: State, robot: Robot, action: RobotActionSellingFoobars
+) -> State:
+    if state.trace:
+        for foobar in action.foobars:
+            state.trace.record(
+                state.clock.n, robot.id, TraceEvent.SOLD, a=foobar.foo, b=foobar.bar
+            )
+    if state.log.events:
+        state.log.write(f"sold {action.foobars} for {action.profit}")
+    state.planned_profit.sub(action.profit)
     state.money.add(action.profit)
     return state
 
 
-def buy_new_robot(state: State, action: RobotActionBuyNewRobot) -> State:
-    print(f"bought a new robot for {action.cost} and {action.foos}")
-    state.robots.append(Robot())
+def buy_new_robot(state: State, robot: Robot, action: RobotActionBuyNewRobot) -> State:
+    new_robot = Robot(len(state.robots))
+    if state.trace:
+        for foo in action.foos:
+            state.trace.record(
+                state.clock.n, robot.id, TraceEvent.BOUGHT, a=foo, b=new_robot.id
+            )
+    if state.log.events:
+        state.log.write(
+            f"bought a new robot for {state.rules.robot_cost} and {action.foos}"
+        )
+    state.robots.append(new_robot)
+    state.idle_robots.add(new_robot.id)
     return state
 
 
+# What happens when a robot finishes an action, by opcode. Robots changing task start their next
+# task instead, and idle robots are never finished.
+FINISH_HANDLERS: List[Optional[Callable[[State, Robot, RobotAction], State]]] = [
+    None
+] * NUM_OPS
+FINISH_HANDLERS[MINING_FOO] = mine_foo
+FINISH_HANDLERS[MINING_BAR] = mine_bar
+FINISH_HANDLERS[ASSEMBLING_FOOBAR] = assemble_foobar
+FINISH_HANDLERS[SELLING_FOOBARS] = sell_foobars
+FINISH_HANDLERS[BUY_NEW_ROBOT] = buy_new_robot
+
+
 def dispatch_robot_actions(state: State) -> State:
-    for robot in state.robots:
-        if not isinstance(robot.action, RobotActionIdle):
-            continue
-        # This robot is idle
+    if state.idle_robots:
+        if state.money < state.rules.robot_cost:
+            state.metrics.buying_blocked_by_money += 1
+        if len(state.foos) <= RobotActionBuyNewRobot.foos_required:
+            state.metrics.buying_blocked_by_foos += 1
+    policy = state.rules.policy or DEFAULT_POLICY
+    for robot_id in sorted(state.idle_robots):
+        state = policy.dispatch(state, state.robots[robot_id])
+        if robot_id in state.idle_robots:
+            raise ValueError(f"{type(policy).__name__} left robot {robot_id} idle.")
+    # nothing changes until the next tick, so this is the world at the end of this one
+    if state.trace and state.trace.snapshot_due:
+        trace_inventories(state, state.clock.n)
+    return state
+
+
+class DispatchPolicy(Protocol):
+    """Decides what idle robots do."""
+
+    def dispatch(self, state: State, robot: Robot) -> State:
+        """Give an idle robot something to do, with one of the `go_*` functions.
+
+        Robots are dispatched in order, and each one must be given an action.
+        """
+
+
+class DefaultPolicy:
+    """Buy robots first, then sell, assemble, and mine what we will lack."""
+
+    def dispatch(self, state: State, robot: Robot) -> State:
         # Prioritize buying more robots whenever possible
-        if can_afford_new_robot(state) and should_this_robot_do_that_action(
-            state, robot, RobotActionBuyNewRobot
-        ):
-            state = go_buy_new_robot(state, robot)
-            continue
+        if can_afford_new_robot(state) and self.should_do(state, robot, BUY_NEW_ROBOT):
+            return go_buy_new_robot(state, robot)
         # Always sell maximum amount of foobars to save time
         if (
             len(state.foobars) >= RobotActionSellingFoobars.max_foobars
-            and state.money < RobotActionBuyNewRobot.cost
-            and should_this_robot_do_that_action(
-                state, robot, RobotActionSellingFoobars
-            )
+            and state.money < state.rules.robot_cost
+            and self.should_do(state, robot, SELLING_FOOBARS)
         ):
-            state = go_sell_foobars(state, robot)
-            continue
+            return go_sell_foobars(state, robot)
         # Assemble foobars if we have surplus resources
         if (
             len(state.foobars) < RobotActionSellingFoobars.max_foobars
             and len(state.foos) > RobotActionBuyNewRobot.foos_required
             and len(state.bars) > 0
-            and should_this_robot_do_that_action(
-                state, robot, RobotActionAssemblingFoobar
-            )
+            and self.should_do(state, robot, ASSEMBLING_FOOBAR)
         ):
-            state = go_assemble_foobars(state, robot)
-            continue
+            return go_assemble_foobars(state, robot)
         # See what resources will be available in the future
         future_state = FutureState(state)
         # Mine foos/bars based on which we need more of
         fb_diff = future_state.num_foos - future_state.num_bars
-        if (
-            fb_diff < RobotActionBuyNewRobot.foos_required
-            and should_this_robot_do_that_action(state, robot, RobotActionMiningFoo)
+        if fb_diff < RobotActionBuyNewRobot.foos_required and self.should_do(
+            state, robot, MINING_FOO
         ):
-            state = go_mine_foos(state, robot)
-            continue
-        else:
-            state = go_mine_bars(state, robot)
-            continue
-    return state
+            return go_mine_foos(state, robot)
+        state.metrics.bars_mined_by_default += 1
+        return go_mine_bars(state, robot)
+
+    def should_do(self, state: State, robot: Robot, op: int) -> bool:
+        return should_this_robot_do_that_action(state, robot, op)
+
+
+DEFAULT_POLICY = DefaultPolicy()
 
 
 def can_afford_new_robot(state: State) -> bool:
-    return (state.money >= RobotActionBuyNewRobot.cost) and (
+    return (state.money >= state.rules.robot_cost) and (
         len(state.foos) > RobotActionBuyNewRobot.foos_required
     )
 
 
-def should_this_robot_do_that_action(
-    state: State, robot: Robot, action: Type[RobotAction]
-) -> bool:
+def should_this_robot_do_that_action(state: State, robot: Robot, op: int) -> bool:
     # Can I do it efficiently?
-    if robot_did_this_action_recently(robot, action):
+    if robot_did_this_action_recently(robot, op):
         return True
     # Can other robots do it for me?
-    for other_robot in state.robots:
-        if other_robot != robot and robot_did_this_action_recently(other_robot, action):
-            return False
+    if state.recent_robots[op]:
+        return False
     # The robots are busy with other things, I must do the task myself.
     return True
 
 
-def robot_did_this_action_recently(robot: Robot, action: Type[RobotAction]) -> bool:
-    return (
-        isinstance(robot.action, RobotActionIdle)
-        and isinstance(robot.action.prev_action, action)
-    ) or (action == RobotActionBuyNewRobot and isinstance(robot.action, action))
+def robot_did_this_action_recently(robot: Robot, op: int) -> bool:
+    if robot.action.opcode == IDLE:
+        return robot.action.prev_op == op
+    return op == BUY_NEW_ROBOT and robot.action.opcode == op
+
+
+def start_robot_action(state: State, robot: Robot, action: RobotAction) -> State:
+    prev_op = robot.action.prev_op
+    if prev_op != IDLE:
+        state.recent_robots[prev_op].discard(robot.id)
+    robot.set_action(action, state.clock)
+    state.idle_robots.discard(robot.id)
+    # actions that take no time still complete on the next tick
+    finishes_at = max(robot.action.finishes_at, state.clock.n + 1)
+    state.timers.schedule(robot.id, finishes_at, state.clock)
+    if robot.action.opcode == CHANGING_TASK:
+        state.metrics.task_changes += 1
+    elif robot.action.opcode == BUY_NEW_ROBOT:
+        state.recent_robots[BUY_NEW_ROBOT].add(robot.id)
+    state.planned_actions[action.opcode] += 1
+    if action.opcode == SELLING_FOOBARS:
+        state.planned_profit.add(action.profit)
+    if state.trace:
+        trace_robot_action(state, robot, action)
+    return state
+
+
+def trace_robot_action(state: State, robot: Robot, action: RobotAction):
+    # task opcodes are trace task codes
+    task = action.opcode
+    # what the robot takes from the inventory for this task
+    a = b = 0
+    if task == ASSEMBLING_FOOBAR:
+        a, b = action.foo, action.bar
+    elif task == SELLING_FOOBARS:
+        a = len(action.foobars)
+    elif task == BUY_NEW_ROBOT:
+        a, b = len(action.foos), state.rules.robot_cost.n
+    state.trace.record(state.clock.n, robot.id, TraceEvent.ASSIGNED, task, a, b)
+    if robot.action.opcode == CHANGING_TASK:
+        state.trace.record(state.clock.n, robot.id, TraceEvent.CHANGING_TASK, task)
+
+
+def trace_inventories(state: State, tick: int):
+    state.trace.snapshot(
+        tick,
+        len(state.robots),
+        len(state.foos),
+        len(state.bars),
+        len(state.foobars),
+        state.money.n,
+    )
 
 
 def go_buy_new_robot(state: State, robot: Robot) -> State:
-    state.money.sub(RobotActionBuyNewRobot.cost)
+    state.money.sub(state.rules.robot_cost)
     fr = RobotActionBuyNewRobot.foos_required
-    foos, state.foos = state.foos[:fr], state.foos[fr:]
+    foos = [state.foos.popleft() for _ in range(fr)]
     action = RobotActionBuyNewRobot(foos)
-    robot.set_action(action)
-    print(f"buying a new robot for {action.cost} and {action.foos}")
+    state = start_robot_action(state, robot, action)
+    if state.log.events:
+        state.log.write(
+            f"buying a new robot for {state.rules.robot_cost} and {action.foos}"
+        )
     return state
 
 
 def go_sell_foobars(state: State, robot: Robot) -> State:
     mf = RobotActionSellingFoobars.max_foobars
-    foobars, state.foobars = state.foobars[:mf], state.foobars[mf:]
+    foobars = [state.foobars.popleft() for _ in range(min(mf, len(state.foobars)))]
     action = RobotActionSellingFoobars(foobars)
-    robot.set_action(action)
-    print(f"selling {action.foobars} for {action.profit}")
+    state = start_robot_action(state, robot, action)
+    if state.log.events:
+        state.log.write(f"selling {action.foobars} for {action.profit}")
     return state
 
 
@@ -400,29 +1207,32 @@ def go_assemble_foobars(state: State, robot: Robot) -> State:
     foo = state.foos.pop()
     bar = state.bars.pop()
     action = RobotActionAssemblingFoobar(foo, bar)
-    robot.set_action(action)
-    print(f"assembling foobar with {foo} and {bar}")
+    state = start_robot_action(state, robot, action)
+    if state.log.events:
+        state.log.write(f"assembling foobar with {foo} and {bar}")
     return state
 
 
 def go_mine_foos(state: State, robot: Robot) -> State:
     action = RobotActionMiningFoo()
-    robot.set_action(action)
-    print(f"mining a foo")
+    state = start_robot_action(state, robot, action)
+    if state.log.events:
+        state.log.write("mining a foo")
     return state
 
 
 def go_mine_bars(state: State, robot: Robot) -> State:
-    action = RobotActionMiningBar()
-    robot.set_action(action)
-    print(f"mining a bar")
+    action = RobotActionMiningBar(state.rng_for(robot, MINING_BAR))
+    state = start_robot_action(state, robot, action)
+    if state.log.events:
+        state.log.write("mining a bar")
     return state
 
 
 def log_state(state: State):
-    print(
-        "|",
-        " | ".join(
+    state.log.write(
+        "| "
+        + " | ".join(
             [
                 f"time:\t{state.clock}",
                 f"robots:\t{len(state.robots)}",
@@ -431,9 +1241,25 @@ def log_state(state: State):
                 f"foobars:\t{len(state.foobars)}",
                 f"money:\t{state.money}",
             ]
-        ),
+        )
+    )
+    # state.log.write("| " + " | ".join(repr(r.action) for r in state.robots))
+
+
+def log_metrics(state: State):
+    metrics = state.metrics
+    state.log.write(
+        f"Robots changed task {metrics.task_changes} times "
+        f"and spent {Time(metrics.task_change_ticks)} moving."
+    )
+    state.log.write(
+        f"Mined bars {metrics.bars_mined_by_default} times for lack of anything else to do."
+    )
+    state.log.write(
+        f"Could not afford a new robot for lack of money in "
+        f"{metrics.buying_blocked_by_money} ticks, and of foos in "
+        f"{metrics.buying_blocked_by_foos} ticks."
     )
-    # print("|", " | ".join(repr(r.action) for r in state.robots))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,285 @@
+"""Simulate many independent worlds in lockstep, to estimate the distribution of finishing times.
+
+Every world follows the rules from `main.py`, but robots of all worlds are entries of flat NumPy
+arrays, robot `j` of world `i` at `i * slots + j`. Worlds are stepped together from one action
+completion to the next: a timer wheel gives the robots finishing at each tick, and a step only
+touches them and their worlds. Dispatch decisions are taken with per-world masks. Only the number
+of foos, bars and foobars matters for finishing times, so inventories are plain counters.
+"""
+
+from __future__ import annotations
+
+from typing import List, Optional
+
+import numpy as np
+
+from fleet import DURATIONS
+from main import (
+    ASSEMBLING_FOOBAR,
+    BUY_NEW_ROBOT,
+    CHANGING_TASK,
+    IDLE,
+    MINING_BAR,
+    MINING_FOO,
+    NUM_OPS,
+    SELLING_FOOBARS,
+    RobotActionAssemblingFoobar,
+    RobotActionBuyNewRobot,
+    RobotActionSellingFoobars,
+    Time,
+)
+
+# No action takes longer than this many ticks, see `main.TimerWheel`
+WHEEL_SIZE = 128
+
+
+class Worlds:
+    """Independent worlds. Per-robot arrays are flat, per-world counts by opcode too."""
+
+    def __init__(self, num_worlds: int, target_robots: int):
+        # robots are bought while others are busy, so a world can overshoot the target
+        self.slots = 2 * target_robots
+        size = num_worlds * self.slots
+        self.op = np.full(size, IDLE, dtype=np.int8)
+        self.prev_op = np.full(size, IDLE, dtype=np.int8)
+        self.next_op = np.zeros(size, dtype=np.int8)
+        self.next_duration = np.zeros(size, dtype=np.int64)
+        self.num_foobars_sold = np.zeros(size, dtype=np.int64)
+        self.num_robots = np.full(
+            num_worlds, 2, dtype=np.int64
+        )  # at the beginning, we have 2
+        self.foos = np.zeros(num_worlds, dtype=np.int64)
+        self.bars = np.zeros(num_worlds, dtype=np.int64)
+        self.foobars = np.zeros(num_worlds, dtype=np.int64)
+        self.money = np.zeros(num_worlds, dtype=np.int64)
+        self.finished = np.zeros(num_worlds, dtype=bool)
+        # at `world * NUM_OPS + op`: busy robots by action they are or will be doing, idle robots
+        # by previous action, and robots buying a robot in the current dispatch pass
+        self.planned = np.zeros(num_worlds * NUM_OPS, dtype=np.int64)
+        self.idle_by_prev = np.zeros(num_worlds * NUM_OPS, dtype=np.int64)
+        self.buying = np.zeros(num_worlds, dtype=np.int64)
+        # robots finishing at each tick, as arrays of robot indexes
+        self.wheel: List[List[np.ndarray]] = [[] for _ in range(WHEEL_SIZE)]
+
+    def __len__(self) -> int:
+        return len(self.num_robots)
+
+    def schedule(self, robots: np.ndarray, ticks: np.ndarray):
+        if not robots.size:
+            return
+        order = np.argsort(ticks, kind="stable")
+        ticks = ticks[order].tolist()
+        robots = robots[order]
+        start = 0
+        for end in (np.flatnonzero(np.diff(ticks)) + 1).tolist() + [len(ticks)]:
+            self.wheel[ticks[start] % WHEEL_SIZE].append(robots[start:end])
+            start = end
+
+    def pop(self, tick: int) -> np.ndarray:
+        """Remove and return robots of unfinished worlds finishing at `tick`."""
+        bucket = self.wheel[tick % WHEEL_SIZE]
+        self.wheel[tick % WHEEL_SIZE] = []
+        if not bucket:
+            return np.zeros(0, dtype=np.int64)
+        robots = np.concatenate(bucket) if len(bucket) > 1 else bucket[0]
+        return robots[~self.finished[robots // self.slots]]
+
+    def next_tick(self, clock: int) -> int:
+        for tick in range(clock + 1, clock + WHEEL_SIZE + 1):
+            if self.wheel[tick % WHEEL_SIZE]:
+                return tick
+        raise ValueError("No robot is busy.")
+
+
+def simulate_worlds(
+    num_worlds: int, seed: Optional[int] = None, target_robots: int = 30
+) -> np.ndarray:
+    """Return the tick at which each world reaches `target_robots` robots."""
+    rng = np.random.default_rng(seed)
+    worlds = Worlds(num_worlds, target_robots)
+    finish_ticks = np.zeros(num_worlds, dtype=np.int64)
+    num_finished = 0
+    clock = 0
+    # the first two robots of every world
+    idle = (np.arange(num_worlds)[:, None] * worlds.slots + np.arange(2)).ravel()
+    while True:
+        if clock:
+            idle = update_worlds_actions_progress(worlds, clock, rng)
+        touched = np.unique(idle // worlds.slots)
+        finished = touched[worlds.num_robots[touched] >= target_robots]
+        if finished.size:
+            finish_ticks[finished] = clock
+            worlds.finished[finished] = True
+            num_finished += finished.size
+            if num_finished == num_worlds:
+                return finish_ticks
+            idle = idle[~worlds.finished[idle // worlds.slots]]
+        dispatch_worlds_actions(worlds, idle, clock, rng)
+        clock = worlds.next_tick(clock)
+
+
+def update_worlds_actions_progress(
+    worlds: Worlds, clock: int, rng: np.random.Generator
+) -> np.ndarray:
+    """Finish the actions of robots due at `clock`, and return the robots now idle, in order."""
+    op = worlds.op
+    due = worlds.pop(clock)
+    # Robots done moving start their next task, which may complete in the same tick
+    switching = op[due] == CHANGING_TASK
+    if switching.any():
+        moved = due[switching]
+        op[moved] = worlds.next_op[moved]
+        durations = worlds.next_duration[moved]
+        later = durations > 0
+        worlds.schedule(moved[later], clock + durations[later])
+        due = np.concatenate((due[~switching], moved[~later]))
+    done_op = op[due]
+    world = due // worlds.slots
+
+    def worlds_of(action: int) -> np.ndarray:
+        return world[done_op == action]
+
+    np.add.at(worlds.foos, worlds_of(MINING_FOO), 1)
+    np.add.at(worlds.bars, worlds_of(MINING_BAR), 1)
+    assembling = worlds_of(ASSEMBLING_FOOBAR)
+    success = rng.random(assembling.size) < RobotActionAssemblingFoobar.success_chance
+    np.add.at(worlds.foobars, assembling[success], 1)
+    # in case of failure the bar can be reused
+    np.add.at(worlds.bars, assembling[~success], 1)
+    selling = done_op == SELLING_FOOBARS
+    np.add.at(worlds.money, world[selling], worlds.num_foobars_sold[due[selling]])
+    np.add.at(worlds.planned, world * NUM_OPS + done_op, -1)
+    worlds.prev_op[due] = done_op
+    op[due] = IDLE
+
+    buyers, bought = np.unique(worlds_of(BUY_NEW_ROBOT), return_counts=True)
+    if buyers.size:
+        # new robots take the next free slots of their world
+        first = np.repeat(buyers * worlds.slots + worlds.num_robots[buyers], bought)
+        offsets = np.arange(first.size) - np.repeat(np.cumsum(bought) - bought, bought)
+        worlds.num_robots[buyers] += bought
+        due = np.concatenate((due, first + offsets))
+    due.sort()
+    return due
+
+
+def dispatch_worlds_actions(
+    worlds: Worlds, idle: np.ndarray, clock: int, rng: np.random.Generator
+):
+    """Give every idle robot something to do, following `main.dispatch_robot_actions`.
+
+    Idle robots are visited in order like in `main.py`, but each visit handles the k-th idle
+    robot of all worlds at once, so a world is never twice in the same visit.
+    """
+    if not idle.size:
+        return
+    op = worlds.op
+    world = idle // worlds.slots
+    np.add.at(worlds.idle_by_prev, world * NUM_OPS + worlds.prev_op[idle], 1)
+    # rank of each idle robot among the idle robots of its world, they are sorted by world
+    rank = np.arange(idle.size) - np.searchsorted(world, world)
+    order = np.argsort(rank, kind="stable")
+    ends = np.cumsum(np.bincount(rank)).tolist()
+    visits = [order[start:end] for start, end in zip([0] + ends, ends)]
+
+    cost = RobotActionBuyNewRobot.cost.n
+    foos_required = RobotActionBuyNewRobot.foos_required
+    max_foobars = RobotActionSellingFoobars.max_foobars
+    failure_chance = 1 - RobotActionAssemblingFoobar.success_chance
+    idle_by_prev = worlds.idle_by_prev
+    planned = worlds.planned
+    # robots given an action and the tick at which it finishes, scheduled once at the end
+    started: List[np.ndarray] = []
+    finishing: List[np.ndarray] = []
+
+    for visit in visits:
+        robots = idle[visit]
+        w = world[visit]
+        row = w * NUM_OPS
+        prev = worlds.prev_op[robots]
+        foos = worlds.foos[w]
+        bars = worlds.bars[w]
+        foobars = worlds.foobars[w]
+        money = worlds.money[w]
+
+        def should_do(action: int) -> np.ndarray:
+            # Can I do it efficiently? Otherwise, can other robots do it for me?
+            others = idle_by_prev[row + action] > 0
+            if action == BUY_NEW_ROBOT:
+                others |= worlds.buying[w] > 0
+            return (prev == action) | ~others
+
+        def start(selected: np.ndarray, action: int, duration):
+            if not selected.any():
+                return
+            chosen = robots[selected]
+            direct = prev[selected] == action
+            idle_by_prev[row[selected] + prev[selected]] -= 1
+            planned[row[selected] + action] += 1
+            op[chosen] = np.where(direct, action, CHANGING_TASK)
+            worlds.next_op[chosen] = action
+            worlds.next_duration[chosen] = duration
+            # actions that take no time complete on the next tick
+            finishes_at = clock + np.where(direct, duration, DURATIONS[CHANGING_TASK])
+            started.append(chosen)
+            finishing.append(np.maximum(finishes_at, clock + 1))
+            if action == BUY_NEW_ROBOT:
+                worlds.buying[w[selected]] += direct
+
+        # Prioritize buying more robots whenever possible
+        buy = (money >= cost) & (foos > foos_required) & should_do(BUY_NEW_ROBOT)
+        worlds.money[w[buy]] -= cost
+        worlds.foos[w[buy]] -= foos_required
+        start(buy, BUY_NEW_ROBOT, DURATIONS[BUY_NEW_ROBOT])
+        rest = ~buy
+        # Always sell maximum amount of foobars to save time
+        sell = (
+            rest
+            & (foobars >= max_foobars)
+            & (money < cost)
+            & should_do(SELLING_FOOBARS)
+        )
+        worlds.foobars[w[sell]] -= max_foobars
+        worlds.num_foobars_sold[robots[sell]] = max_foobars
+        start(sell, SELLING_FOOBARS, DURATIONS[SELLING_FOOBARS])
+        rest &= ~sell
+        # Assemble foobars if we have surplus resources
+        assemble = (
+            rest
+            & (foobars < max_foobars)
+            & (foos > foos_required)
+            & (bars > 0)
+            & should_do(ASSEMBLING_FOOBAR)
+        )
+        worlds.foos[w[assemble]] -= 1
+        worlds.bars[w[assemble]] -= 1
+        start(assemble, ASSEMBLING_FOOBAR, DURATIONS[ASSEMBLING_FOOBAR])
+        rest &= ~assemble
+        # Mine foos/bars based on which we need more of
+        num_foos = worlds.foos[w] + planned[row + MINING_FOO]
+        num_bars = (
+            worlds.bars[w]
+            + planned[row + MINING_BAR]
+            + planned[row + ASSEMBLING_FOOBAR] * failure_chance
+        )
+        mine_foo = rest & (num_foos - num_bars < foos_required) & should_do(MINING_FOO)
+        start(mine_foo, MINING_FOO, DURATIONS[MINING_FOO])
+        mine_bar = rest & ~mine_foo
+        durations = (
+            np.round(rng.random(np.count_nonzero(mine_bar)) * 15).astype(np.int64) + 5
+        )
+        start(mine_bar, MINING_BAR, durations)
+    worlds.schedule(np.concatenate(started), np.concatenate(finishing))
+    worlds.buying[world] = 0
+
+
+def log_finish_times(finish_ticks: np.ndarray, seed: int):
+    seconds = finish_ticks / 10
+    p5, p50, p95 = np.percentile(seconds, [5, 50, 95])
+    print(f"Finished {len(seconds)} worlds with seed {seed}:")
+    print(f"mean:\t{seconds.mean():.1f}s ± {seconds.std():.1f}s")
+    print(f"min:\t{Time(int(finish_ticks.min()))}")
+    print(f"p5:\t{p5:.1f}s")
+    print(f"p50:\t{p50:.1f}s")
+    print(f"p95:\t{p95:.1f}s")
+    print(f"max:\t{Time(int(finish_ticks.max()))}")
@@ -0,0 +1,99 @@
+"""Timings of each phase of the simulation loop, kept in fixed-size histograms.
+
+A `PhaseProfiler` wraps the phase functions of `main.run_ticks` and `main.run_events`, and records
+how long each call took in the histogram of the window of ticks it happened in. Its JSON export
+gives the p50, p99 and max duration of each phase for every window, so slow ticks caused by many
+robots going idle at once stand out from steady-state ones.
+"""
+
+from __future__ import annotations
+
+import json
+import math
+import time
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+
+PHASES = ("update", "dispatch", "log")
+# Bucket i holds durations up to 2^((i + 1) / BUCKETS_PER_OCTAVE) ns, which resolves quantiles
+# within 19% and goes up to 2^40 ns, about 18 minutes.
+BUCKETS_PER_OCTAVE = 4
+NUM_BUCKETS = 40 * BUCKETS_PER_OCTAVE
+
+T = TypeVar("T")
+
+
+class Histogram:
+    """Durations in nanoseconds, counted in logarithmic buckets."""
+
+    __slots__ = ("counts", "count", "max")
+
+    def __init__(self):
+        self.counts = [0] * NUM_BUCKETS
+        self.count = 0
+        self.max = 0
+
+    def add(self, ns: int):
+        bucket = int(math.log2(ns + 1) * BUCKETS_PER_OCTAVE)
+        self.counts[min(bucket, NUM_BUCKETS - 1)] += 1
+        self.count += 1
+        if ns > self.max:
+            self.max = ns
+
+    def quantile(self, q: float) -> float:
+        """Return an upper bound of the `q` quantile, in nanoseconds."""
+        rank = q * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(2 ** ((bucket + 1) / BUCKETS_PER_OCTAVE), self.max)
+        return self.max
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "p50_us": round(self.quantile(0.5) / 1000, 3),
+            "p99_us": round(self.quantile(0.99) / 1000, 3),
+            "max_us": round(self.max / 1000, 3),
+        }
+
+
+class PhaseProfiler:
+    """Histograms of phase durations, for every `window` ticks."""
+
+    def __init__(self, window: int = 1000):
+        self.window = window
+        self.windows: Dict[int, Dict[str, Histogram]] = {}
+
+    def record(self, phase: str, tick: int, ns: int):
+        histograms = self.windows.get(tick // self.window)
+        if histograms is None:
+            histograms = {p: Histogram() for p in PHASES}
+            self.windows[tick // self.window] = histograms
+        histograms[phase].add(ns)
+
+    def timed(self, phase: str, func: Callable[[T], Optional[T]]):
+        """Wrap a phase function, which takes the simulation state, to record its durations."""
+        clock = time.perf_counter_ns
+
+        def timed_phase(state: T) -> Optional[T]:
+            start = clock()
+            result = func(state)
+            self.record(phase, state.clock.n, clock() - start)
+            return result
+
+        return timed_phase
+
+    def to_json(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "ticks": [i * self.window, (i + 1) * self.window - 1],
+                **{phase: h.summary() for phase, h in histograms.items() if h.count},
+            }
+            for i, histograms in sorted(self.windows.items())
+        ]
+
+    def write(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.to_json(), f, indent=1)
+            f.write("\n")
@@ -0,0 +1,149 @@
+import gc
+import io
+import random
+import tracemalloc
+import unittest
+
+import checkpoint
+from main import (
+    IDLE_AFTER,
+    Log,
+    LogLevel,
+    Money,
+    Rules,
+    State,
+    run_events,
+    run_ticks,
+    update_robot_actions_progress,
+)
+
+try:
+    import fleet
+except ImportError:  # fleet needs numpy
+    fleet = None
+
+SEEDS = range(5)
+# tick at which runs are checkpointed or forked, about halfway to 30 robots
+MIDWAY = 2000
+
+# Ticks of a run with a fixed fleet over which we measure memory, and the most it may grow per
+# action finished in them. Robots only keep their current action, so once the fleet stops growing
+# memory only changes by a constant: keeping one more object per action would be at least 32 bytes.
+STEADY_TICKS = 4000
+MAX_BYTES_PER_ACTION = 8
+
+
+class AllocationTest(unittest.TestCase):
+    def test_idle_robots_share_actions(self):
+        state = run_events(State(random.Random(1), lineage=False), 300, until=2000)
+        # the loop stopped before the next completions, let robots finish their actions
+        state = update_robot_actions_progress(state)
+        idle = [state.robots[i].action for i in state.idle_robots]
+        self.assertTrue(idle)
+        for action in idle:
+            self.assertIs(action, IDLE_AFTER[action.prev_op])
+
+    def test_steady_state_allocations(self):
+        state = run_events(State(random.Random(1), lineage=False), 300)
+        # robots are too expensive to buy from now on, let the fleet settle
+        state = state.fork(Rules(robot_cost=Money(10**12)))
+        state = run_events(state, 10**9, until=state.clock.n + 500)
+        robots = len(state.robots)
+        actions = state.metrics.finished_actions
+        gc.collect()
+        tracemalloc.start()
+        try:
+            start, _ = tracemalloc.get_traced_memory()
+            state = run_events(state, 10**9, until=state.clock.n + STEADY_TICKS)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(len(state.robots), robots)
+        actions = state.metrics.finished_actions - actions
+        self.assertLess((peak - start) / actions, MAX_BYTES_PER_ACTION)
+
+
+def outcome(state: State):
+    """What a run to 30 robots ends with, including its random generator."""
+    return (
+        state.clock.n,
+        len(state.robots),
+        state.money.n,
+        [int(foo) for foo in state.foos],
+        [int(bar) for bar in state.bars],
+        [(int(foobar.foo), int(foobar.bar)) for foobar in state.foobars],
+        state.metrics.as_dict(),
+        state.rng.getstate(),
+    )
+
+
+def run_with_log(engine, state: State, out: io.StringIO, until=None) -> State:
+    state.log = Log(LogLevel.EVENT, out)
+    state = engine(state, until=until)
+    state.log.flush()
+    return state
+
+
+def without_states(log: str):
+    return [line for line in log.splitlines() if not line.startswith("| ")]
+
+
+class EngineTest(unittest.TestCase):
+    """Every way of running a seeded simulation gives the same run as `run_ticks`."""
+
+    def run_ticks(self, seed: int):
+        out = io.StringIO()
+        state = run_with_log(run_ticks, State(random.Random(seed)), out)
+        return outcome(state), out.getvalue()
+
+    def test_events(self):
+        for seed in SEEDS:
+            out = io.StringIO()
+            state = run_with_log(run_events, State(random.Random(seed)), out)
+            expected, log = self.run_ticks(seed)
+            self.assertEqual(outcome(state), expected)
+            # ticks where nothing happens are skipped, so only their state lines are missing
+            self.assertEqual(without_states(out.getvalue()), without_states(log))
+
+    @unittest.skipIf(fleet is None, "needs numpy")
+    def test_fleet(self):
+        for seed in SEEDS:
+            state = fleet.run_fleet(fleet.FleetState(random.Random(seed)))
+            expected, _ = self.run_ticks(seed)
+            # fleets don't keep metrics
+            self.assertEqual(
+                (
+                    state.clock,
+                    len(state.fleet),
+                    state.money,
+                    list(state.foos),
+                    state.bars,
+                    [tuple(foobar) for foobar in state.foobars],
+                    state.rng.getstate(),
+                ),
+                expected[:6] + expected[7:],
+            )
+
+    def test_checkpoint(self):
+        for seed in SEEDS:
+            out = io.StringIO()
+            state = run_with_log(run_ticks, State(random.Random(seed)), out, MIDWAY)
+            saved = io.BytesIO()
+            checkpoint.dump(state, saved)
+            saved.seek(0)
+            state = run_with_log(run_ticks, checkpoint.read(saved), out)
+            self.assertEqual((outcome(state), out.getvalue()), self.run_ticks(seed))
+
+    def test_fork(self):
+        for seed in SEEDS:
+            out = io.StringIO()
+            state = run_with_log(run_ticks, State(random.Random(seed)), out, MIDWAY)
+            midway = outcome(state)
+            forked = run_with_log(run_ticks, state.fork(), out)
+            self.assertEqual((outcome(forked), out.getvalue()), self.run_ticks(seed))
+            # the original world is left as it was
+            self.assertEqual(outcome(state), midway)
+
+
+if __name__ == "__main__":
+    unittest.main()
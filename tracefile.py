@@ -0,0 +1,304 @@
+"""Compact binary trace of everything that happens in a simulation.
+
+A trace file is a header followed by fixed-width records, one per state transition:
+
+    tick    u32  tick at which it happened
+    robot   u32  robot which did it
+    event   u16  one of `TraceEvent`
+    arg     u16  the task, for `TraceEvent.ASSIGNED` and `TraceEvent.CHANGING_TASK`
+    a       u32  first operand, see `TraceEvent`
+    b       u32  second operand, see `TraceEvent`
+
+Records are in tick order, so `TraceReader` can find ticks in a memory-mapped trace with a sparse
+index instead of reading it from the start. Every `SNAPSHOT_EVERY` records or so, the simulation
+also writes its inventories at the end of the tick, so the world at any tick is rebuilt from the
+last snapshot before it instead of from the start. Run `python3 tracefile.py --help` to query a
+trace.
+"""
+
+from __future__ import annotations
+
+import argparse
+import bisect
+import mmap
+import struct
+from enum import IntEnum
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+MAGIC = b"FBTR"
+VERSION = 2
+HEADER = struct.Struct("<4sI")
+RECORD = struct.Struct("<IIHHII")
+# the event of a record, after its tick and robot
+EVENT = struct.Struct("<8xH")
+SNAPSHOT_EVERY = 4096
+
+
+class TraceEvent(IntEnum):
+    CHANGING_TASK = 1  # arg: task the robot moves to
+    MINED_FOO = 2  # a: foo
+    MINED_BAR = 3  # a: bar
+    ASSEMBLED = 4  # a: foo, b: bar
+    ASSEMBLY_FAILED = 5  # a: foo which is lost, b: bar which is recovered
+    SOLD = 6  # a: foo, b: bar of a foobar sold, one record per foobar
+    BOUGHT = 7  # a: foo spent, b: robot bought, one record per foo
+    # arg: task given to the robot, and what it takes from the inventory for it:
+    # a: foo, b: bar to assemble; a: number of foobars to sell; a: number of foos, b: money to buy
+    ASSIGNED = 8
+    # inventories at the end of the tick, in two records written together:
+    # robot: number of robots, a: foos, b: bars; then a: foobars, b: money
+    SNAPSHOT = 9
+    SNAPSHOT_MONEY = 10
+
+
+class Task(IntEnum):
+    """Tasks a robot can move to, which are also their opcodes in `main.py`."""
+
+    MINING_FOO = 2
+    MINING_BAR = 3
+    ASSEMBLING_FOOBAR = 4
+    SELLING_FOOBARS = 5
+    BUY_NEW_ROBOT = 6
+
+
+class TraceWriter:
+    """Writes trace records to a binary file, in large chunks."""
+
+    def __init__(self, out: BinaryIO, buffer_size: int = 1 << 20):
+        self.out = out
+        self.buffer_size = buffer_size
+        self.buffer = bytearray(HEADER.pack(MAGIC, VERSION))
+        # records written since the last snapshot
+        self.unsnapshotted = 0
+
+    @classmethod
+    def open(cls, path: str, buffer_size: int = 1 << 20) -> TraceWriter:
+        return cls(open(path, "wb"), buffer_size)
+
+    def record(
+        self,
+        tick: int,
+        robot: int,
+        event: TraceEvent,
+        arg: int = 0,
+        a: int = 0,
+        b: int = 0,
+    ):
+        self.buffer += RECORD.pack(tick, robot, event, arg, a, b)
+        self.unsnapshotted += 1
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    @property
+    def snapshot_due(self) -> bool:
+        return self.unsnapshotted >= SNAPSHOT_EVERY
+
+    def snapshot(
+        self, tick: int, robots: int, foos: int, bars: int, foobars: int, money: int
+    ):
+        """Record the inventories at the end of `tick`."""
+        self.record(tick, robots, TraceEvent.SNAPSHOT, a=foos, b=bars)
+        self.record(tick, 0, TraceEvent.SNAPSHOT_MONEY, a=foobars, b=money)
+        self.unsnapshotted = 0
+
+    def flush(self):
+        self.out.write(self.buffer)
+        self.buffer.clear()
+        self.out.flush()
+
+    def close(self):
+        self.flush()
+        self.out.close()
+
+
+Record = Tuple[int, int, int, int, int, int]
+
+
+class World:
+    """Inventories of a traced simulation at some tick, rebuilt from its records."""
+
+    def __init__(self):
+        self.tick = 0
+        self.robots = 2
+        self.foos = 0
+        self.bars = 0
+        self.foobars = 0
+        self.money = 0
+
+    def __str__(self) -> str:
+        return "| " + " | ".join(
+            [
+                f"time:\t{self.tick / 10}s",
+                f"robots:\t{self.robots}",
+                f"foos:\t{self.foos}",
+                f"bars:\t{self.bars}",
+                f"foobars:\t{self.foobars}",
+                f"money:\t{self.money}€",
+            ]
+        )
+
+    def apply(self, record: Record):
+        tick, _, event, arg, a, b = record
+        self.tick = tick
+        if event == TraceEvent.MINED_FOO:
+            self.foos += 1
+        elif event == TraceEvent.MINED_BAR or event == TraceEvent.ASSEMBLY_FAILED:
+            self.bars += 1
+        elif event == TraceEvent.ASSEMBLED:
+            self.foobars += 1
+        elif event == TraceEvent.SOLD:
+            self.money += 1
+        elif event == TraceEvent.BOUGHT:
+            # robot ids are given in order
+            self.robots = max(self.robots, b + 1)
+        elif event == TraceEvent.ASSIGNED:
+            if arg == Task.ASSEMBLING_FOOBAR:
+                self.foos -= 1
+                self.bars -= 1
+            elif arg == Task.SELLING_FOOBARS:
+                self.foobars -= a
+            elif arg == Task.BUY_NEW_ROBOT:
+                self.foos -= a
+                self.money -= b
+        elif event == TraceEvent.SNAPSHOT:
+            self.robots, self.foos, self.bars = record[1], a, b
+        elif event == TraceEvent.SNAPSHOT_MONEY:
+            self.foobars, self.money = a, b
+
+
+class TraceReader:
+    """Random access to a trace file, through a memory map and a sparse index of ticks."""
+
+    def __init__(self, path: str, index_every: int = 4096):
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = HEADER.unpack_from(self.data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} trace file.")
+        self.num_records = (len(self.data) - HEADER.size) // RECORD.size
+        self.index_every = index_every
+        # tick of every `index_every`-th record
+        self.index = [
+            RECORD.unpack_from(self.data, self.offset(i))[0]
+            for i in range(0, self.num_records, index_every)
+        ]
+
+    def __enter__(self) -> TraceReader:
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.num_records
+
+    def __getitem__(self, i: int) -> Record:
+        if not 0 <= i < self.num_records:
+            raise IndexError(i)
+        return RECORD.unpack_from(self.data, self.offset(i))
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def offset(self, i: int) -> int:
+        return HEADER.size + i * RECORD.size
+
+    def records(self, start: int = 0, stop: Optional[int] = None) -> Iterator[Record]:
+        """Iterate over records `start` to `stop`, reading one index block at a time."""
+        stop = self.num_records if stop is None else min(stop, self.num_records)
+        for i in range(start, stop, self.index_every):
+            chunk = self.data[
+                self.offset(i) : self.offset(min(i + self.index_every, stop))
+            ]
+            yield from RECORD.iter_unpack(chunk)
+
+    def bisect(self, tick: int) -> int:
+        """Return the position of the first record at or after `tick`."""
+        block = max(bisect.bisect_left(self.index, tick) - 1, 0)
+        start = block * self.index_every
+        # the record is in this block, or is the first one of the next block
+        for i, record in enumerate(
+            self.records(start, start + self.index_every), start
+        ):
+            if record[0] >= tick:
+                return i
+        return min(start + self.index_every, self.num_records)
+
+    def between(self, start_tick: int, end_tick: int) -> Iterator[Record]:
+        """Iterate over records from `start_tick` to `end_tick`, both included.
+
+        Snapshots are left out, they are not something that happened.
+        """
+        for record in self.records(self.bisect(start_tick)):
+            if record[0] > end_tick:
+                return
+            if record[2] < TraceEvent.SNAPSHOT:
+                yield record
+
+    def world_at(self, tick: int) -> World:
+        """Return the world as it is at the end of `tick`."""
+        stop = self.bisect(tick + 1)
+        world = World()
+        for record in self.records(self.last_snapshot(stop), stop):
+            world.apply(record)
+        world.tick = tick
+        return world
+
+    def last_snapshot(self, stop: int) -> int:
+        """Return the position of the last snapshot before record `stop`, or 0 if there is none.
+
+        Snapshots are written every `SNAPSHOT_EVERY` records or so, so this reads about that many
+        records back at most.
+        """
+        for i in range(stop - 1, -1, -1):
+            (event,) = EVENT.unpack_from(self.data, self.offset(i))
+            if event == TraceEvent.SNAPSHOT:
+                return i
+        return 0
+
+
+def format_record(record: Record) -> str:
+    tick, robot, event, arg, a, b = record
+    event = TraceEvent(event)
+    if event == TraceEvent.CHANGING_TASK:
+        details = Task(arg).name.lower()
+    elif event == TraceEvent.ASSIGNED:
+        details = f"{Task(arg).name.lower()} a={a} b={b}"
+    elif event == TraceEvent.MINED_FOO:
+        details = f"foo_{a}"
+    elif event == TraceEvent.MINED_BAR:
+        details = f"bar_{a}"
+    elif event == TraceEvent.BOUGHT:
+        details = f"foo_{a} robot_{b}"
+    else:
+        details = f"foo_{a} bar_{b}"
+    return f"{tick / 10}s\trobot_{robot}\t{event.name.lower()}\t{details}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query a trace recorded with --trace.")
+    parser.add_argument("trace", help="trace file")
+    query = parser.add_mutually_exclusive_group(required=True)
+    query.add_argument(
+        "--at", type=float, help="show the world at this time, in seconds"
+    )
+    query.add_argument(
+        "--between",
+        type=float,
+        nargs=2,
+        metavar=("START", "END"),
+        help="show all events between these times, in seconds",
+    )
+    args = parser.parse_args()
+    with TraceReader(args.trace) as reader:
+        if args.at is not None:
+            print(reader.world_at(round(args.at * 10)))
+        else:
+            start, end = args.between
+            for record in reader.between(round(start * 10), round(end * 10)):
+                print(format_record(record))
+
+
+if __name__ == "__main__":
+    main()